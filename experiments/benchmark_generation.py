@@ -0,0 +1,242 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+from pathlib import Path
+from time import perf_counter
+import json
+import platform
+import sys
+
+import brian2
+import numpy as np
+import scipy
+import yaml
+
+from generate_data import make_trajectory_sampler, sample_batch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# solvers that step a system of ODEs, as opposed to the spectral ("SM") and Brian2 simulators
+_ODE_METHODS = ("RK23", "RK45", "DOP853", "Radau", "BDF", "LSODA")
+
+
+def parse_args():
+    ap = ArgumentParser()
+
+    ap.add_argument('configs',
+                    type=str,
+                    nargs='*',
+                    help="YAML files defining trajectory samplers "
+                    "(default: every file in data_generation/)")
+
+    ap.add_argument('--methods',
+                    type=str,
+                    nargs='+',
+                    help="Solvers to benchmark every ODE model with "
+                    "(default: the method of each config)",
+                    default=None)
+
+    ap.add_argument('--time_horizon',
+                    type=float,
+                    help="Time horizon",
+                    default=50.)
+
+    ap.add_argument('--n_trajectories',
+                    type=int,
+                    help="Number of trajectories to time per benchmark",
+                    default=10)
+
+    ap.add_argument('--n_samples',
+                    type=int,
+                    help="Number of state samples per trajectory",
+                    default=50)
+
+    ap.add_argument('--batch_size',
+                    type=int,
+                    help="Number of trajectories integrated together as one stacked system",
+                    default=1)
+
+    ap.add_argument('--seed',
+                    type=int,
+                    help="Seed from which the seed of every trajectory is derived",
+                    default=0)
+
+    ap.add_argument('--output',
+                    type=str,
+                    help="Write the results to this JSON file",
+                    default=None)
+
+    ap.add_argument('--baseline',
+                    type=str,
+                    help="JSON file of an earlier run to compare against",
+                    default=None)
+
+    ap.add_argument('--tolerance',
+                    type=float,
+                    help="Relative slowdown of trajectories/s reported as a regression",
+                    default=0.1)
+
+    return ap.parse_args()
+
+
+def benchmark_names(config, methods):
+    '''Returns (name, method) for every benchmark of one config, where
+    method None keeps the method of the config.'''
+    with open(config, 'r') as f:
+        settings: dict = yaml.load(f, Loader=yaml.FullLoader)
+
+    sampler = make_trajectory_sampler(settings)
+    stem = Path(config).stem
+
+    if methods is None or sampler._ode_method not in _ODE_METHODS:
+        return [(f"{stem}/{sampler._ode_method}", None)]
+
+    return [(f"{stem}/{method}", method) for method in methods]
+
+
+def run_benchmark(config, method, time_horizon, n_trajectories, n_samples,
+                  batch_size, seed):
+    '''Times the generation of n_trajectories trajectories. Meant to run in a
+    fresh process, so that the peak memory belongs to this benchmark.'''
+    with open(config, 'r') as f:
+        settings: dict = yaml.load(f, Loader=yaml.FullLoader)
+    if method is not None:
+        settings["method"] = method
+
+    sampler = make_trajectory_sampler(settings)
+    seeds = np.random.SeedSequence(seed).spawn(n_trajectories + 1)
+
+    # the first trajectory pays for imports, caches and code generation
+    sample_batch(sampler, seeds[:1], time_horizon, n_samples)
+    sampler.reset_stats()
+
+    start = perf_counter()
+    for i in range(1, n_trajectories + 1, batch_size):
+        sample_batch(sampler, seeds[i:i + batch_size], time_horizon,
+                     n_samples)
+    elapsed = perf_counter() - start
+
+    is_ode = sampler._ode_method in _ODE_METHODS
+    stats = dict(sampler.stats) if is_ode else {
+        k: None
+        for k in sampler.stats
+    }
+    # rejected steps are only known for the explicit Runge-Kutta methods
+    if sampler._ode_method not in ("RK23", "RK45", "DOP853"):
+        stats["n_rejected"] = None
+
+    if resource is None:
+        peak_memory_mb = None
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        peak_memory_mb = peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+    return {
+        "dynamics": settings["dynamics"]["name"],
+        "method": sampler._ode_method,
+        "n_trajectories": n_trajectories,
+        "seconds": elapsed,
+        "trajectories_per_second": n_trajectories / elapsed,
+        **stats,
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Prints the change of every benchmark relative to the baseline and
+    returns the names of those that got slower by more than tolerance.'''
+    regressions = []
+
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name}: failed")
+            regressions.append(name)
+            continue
+
+        if name not in baseline or "error" in baseline[name]:
+            print(f"{name}: not in baseline")
+            continue
+
+        old = baseline[name]
+        ratio = result["trajectories_per_second"] / old[
+            "trajectories_per_second"]
+        line = f"{name}: {ratio:.2f}x trajectories/s"
+
+        if result["nfev"] is not None and old["nfev"] != result["nfev"]:
+            line += f", nfev {old['nfev']} -> {result['nfev']}"
+
+        if ratio < 1. - tolerance:
+            line += "  REGRESSION"
+            regressions.append(name)
+
+        print(line)
+
+    return regressions
+
+
+def main():
+    args = parse_args()
+    configs = args.configs or sorted(
+        str(p) for p in Path(__file__).parent.parent.joinpath(
+            "data_generation").glob("*.yaml"))
+
+    results = {}
+    for config in configs:
+        try:
+            benchmarks = benchmark_names(config, args.methods)
+        except Exception as e:
+            # a broken config should not stop the other benchmarks
+            results[Path(config).stem] = {"error": repr(e)}
+            print(f"{config}: failed with {e!r}")
+            continue
+
+        for name, method in benchmarks:
+            # a fresh process per benchmark
+            with ProcessPoolExecutor(
+                    max_workers=1, mp_context=mp.get_context("spawn")) as pool:
+                try:
+                    result = pool.submit(run_benchmark, config, method,
+                                         args.time_horizon,
+                                         args.n_trajectories, args.n_samples,
+                                         args.batch_size, args.seed).result()
+                except Exception as e:
+                    results[name] = {"error": repr(e)}
+                    print(f"{name}: failed with {e!r}")
+                    continue
+
+            results[name] = result
+            print(f"{name}: {result['trajectories_per_second']:.3g} "
+                  f"trajectories/s, nfev {result['nfev']}, "
+                  f"steps {result['n_steps']}, "
+                  f"rejected {result['n_rejected']}, "
+                  f"peak memory {result['peak_memory_mb']} MB")
+
+    report = {
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "brian2": brian2.__version__,
+        },
+        "args": vars(args),
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)["results"]
+
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import pickle
+from argparse import ArgumentParser
+from pathlib import Path
+
+from RHYME_XT.shards import load_sharded
+from RHYME_XT.arrays import save_arrays
+
+
+def parse_args():
+    ap = ArgumentParser()
+
+    ap.add_argument(
+        'load_path',
+        type=str,
+        help="Path to a data file, or a directory of shards, written by semble_generate.py")
+
+    ap.add_argument(
+        'output_path',
+        type=str,
+        help="Directory to write the memory-mappable array layout to")
+
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    data_path = Path(args.load_path)
+
+    if data_path.is_dir():
+        data = load_sharded(data_path)
+    else:
+        with data_path.open('rb') as f:
+            data = pickle.load(f)
+
+    save_arrays(data, args.output_path)
+
+
+if __name__ == '__main__':
+    main()
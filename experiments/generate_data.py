@@ -4,10 +4,31 @@ from semble.sequence_generators import get_sequence_generator
 from semble.initial_state import get_initial_state_generator
 
 from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import multiprocessing as mp
+import os
+import pickle
+from pathlib import Path
+import yaml
 from RHYME_XT import RawTrajectoryDataset
+from RHYME_XT.shards import ShardWriter, dump_atomic
 import torch
 import numpy as np
 
+# environment variables read by the BLAS/OpenMP runtimes of numpy, scipy and torch
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                    "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+# arguments that have to match when a run is resumed
+_RESUME_ARGS = ("settings", "time_horizon", "n_trajectories", "n_samples",
+                "noise_std", "data_split", "noise_std_svd",
+                "num_locations_svd", "batch_size", "shard_size")
+
+CHECKPOINT_NAME = "checkpoint.pkl"
+
+_worker_sampler = None
+
 def percentage(value):
     value = int(value)
 
@@ -75,9 +96,135 @@ def parse_args():
         help="Ratio of number of spatial locations to use in SVD calculation (spatial interpolation experiment)",
         default=1.0)
 
+    ap.add_argument('--seed',
+                    type=int,
+                    help="Seed from which the seed of every trajectory is derived",
+                    default=None)
+
+    ap.add_argument('--n_workers',
+                    type=int,
+                    help="Number of worker processes used to sample trajectories",
+                    default=1)
+
+    ap.add_argument('--threads_per_worker',
+                    type=int,
+                    help="Number of BLAS/OpenMP threads per worker process",
+                    default=1)
+
+    ap.add_argument('--batch_size',
+                    type=int,
+                    help="Number of trajectories integrated together as one stacked system. "
+                    "For ODE models the data depends on it (within the solver tolerances).",
+                    default=1)
+
+    ap.add_argument('--shard_size',
+                    type=int,
+                    help="Write the data to a directory, in files of this many trajectories, "
+                    "while it is generated. If 0, everything is written to one file at the end.",
+                    default=0)
+
+    ap.add_argument('--checkpoint_every',
+                    type=int,
+                    help="Number of trajectories between checkpoints of the run (0 to disable)",
+                    default=100)
+
+    ap.add_argument('--resume',
+                    action='store_true',
+                    help="Continue an interrupted run with the same output_name from its last checkpoint")
+
     return ap.parse_args()
 
-def generate(args, trajectory_sampler: TrajectorySampler, postprocess=[]):
+def sample_batch(trajectory_sampler: TrajectorySampler, seeds, time_horizon,
+                 n_samples, full_state=True):
+    if len(seeds) == 1:
+        trajectory_sampler.reset_rngs(seeds[0])
+        trajectories = [
+            trajectory_sampler.get_example(time_horizon, n_samples,
+                                           full_state)
+        ]
+    else:
+        trajectories = trajectory_sampler.get_example_batch(
+            time_horizon, n_samples, seeds, full_state)
+
+    return [{
+        "init_state": x0,
+        "time": t,
+        "state": y,
+        "control": u,
+        "full_state": y_full
+    } for (x0, t, y, u, y_full) in trajectories]
+
+
+@contextmanager
+def _limit_worker_threads(n_threads):
+    # spawned workers read these when they import numpy/torch
+    old_env = {k: os.environ.get(k) for k in _THREAD_ENV_VARS}
+    os.environ.update({k: str(n_threads) for k in _THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for k, v in old_env.items():
+            if v is None:
+                os.environ.pop(k)
+            else:
+                os.environ[k] = v
+
+
+def _init_worker(settings_path, n_threads):
+    global _worker_sampler
+    torch.set_num_threads(n_threads)
+
+    with open(settings_path, 'r') as f:
+        settings: dict = yaml.load(f, Loader=yaml.FullLoader)
+
+    _worker_sampler = make_trajectory_sampler(settings)
+
+
+def _worker_batch(job):
+    return sample_batch(_worker_sampler, *job)
+
+
+def iter_examples(args, trajectory_sampler: TrajectorySampler, seeds,
+                  start=0, n_full_state=None):
+    '''Samples one trajectory per seed and yields them in the order of the seeds,
+    skipping the first start ones. The full state is only kept for the first
+    n_full_state trajectories (all if None), the others get None.
+
+    With more than one worker, every worker builds its own sampler from
+    args.settings, so the result does not depend on the number of workers.'''
+    n = len(seeds)
+    bs = max(1, args.batch_size)
+    n_full_state = n if n_full_state is None else n_full_state
+    jobs = [(seeds[i:i + bs], args.time_horizon, args.n_samples,
+             i < n_full_state) for i in range(start, n, bs)]
+
+    def unbatch(batches):
+        k = start
+        for batch in batches:
+            for example in batch:
+                if k % 100 == 0:
+                    print(f"Generating dataset example {k+1}/{n}")
+                k += 1
+                yield example
+
+    if args.n_workers <= 1:
+        yield from unbatch(
+            sample_batch(trajectory_sampler, *job) for job in jobs)
+        return
+
+    chunksize = max(1, len(jobs) // (4 * args.n_workers))
+
+    with _limit_worker_threads(args.threads_per_worker):
+        with ProcessPoolExecutor(max_workers=args.n_workers,
+                                 mp_context=mp.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(args.settings,
+                                           args.threads_per_worker)) as pool:
+            yield from unbatch(
+                pool.map(_worker_batch, jobs, chunksize=chunksize))
+
+
+def split_sizes(args):
     if args.data_split[0] + args.data_split[1] >= 100:
         raise Exception("Invalid data split.")
     
@@ -85,64 +232,247 @@ def generate(args, trajectory_sampler: TrajectorySampler, postprocess=[]):
     n_test = int(args.n_trajectories * (args.data_split[1] / 100.))
     n_train = args.n_trajectories - n_val - n_test
 
-    def get_example():
-        x0, t, y, u, y_full = trajectory_sampler.get_example(args.time_horizon,
-                                                     args.n_samples)
-        
-        return {
-            "init_state": x0,
-            "time": t,
-            "state": y,
-            "control": u,
-            "full_state": y_full
-        }
-    train_data = []
-    for i in range(n_train):
-        if i % 100 == 0:
-            print(f"Generating training dataset example {i+1}/{n_train}")
-        example = get_example()
-        train_data.append(example)
-    trajectory_sampler.reset_rngs()
-
-    val_data = [get_example() for _ in range(n_val)]
-    trajectory_sampler.reset_rngs()
-
-    test_data = [get_example() for _ in range(n_test)]
-
-    states_combined = torch.cat([
-    torch.tensor(d["full_state"], dtype=torch.get_default_dtype())
-    for d in train_data
-    ], dim=0)
-    
-    selected_indices = torch.linspace(0, states_combined.shape[1]-1, steps=int(states_combined.shape[1]*args.num_locations_svd)).long()
-    PHI, _, _ = torch.linalg.svd(states_combined[:, selected_indices].T + args.noise_std_svd * torch.randn_like(states_combined[:, selected_indices].T),full_matrices=False)
-    
-    train_data = RawTrajectoryDataset(train_data,
-                                      *trajectory_sampler.dims(),
-                                      delta=trajectory_sampler._delta,
-                                      output_mask=trajectory_sampler._dyn.mask,
-                                      input_mask=trajectory_sampler._dyn.input_mask,
-                                      noise_std=args.noise_std)
-
-    val_data = RawTrajectoryDataset(val_data,
-                                    *trajectory_sampler.dims(),
-                                    delta=trajectory_sampler._delta,
-                                    output_mask=trajectory_sampler._dyn.mask,
-                                    input_mask=trajectory_sampler._dyn.input_mask,
-                                    noise_std=args.noise_std)
-
-    test_data = RawTrajectoryDataset(test_data,
-                                     *trajectory_sampler.dims(),
-                                     delta=trajectory_sampler._delta,
-                                     output_mask=trajectory_sampler._dyn.mask,
-                                     input_mask=trajectory_sampler._dyn.input_mask,
-                                     noise_std=args.noise_std)
-
-    for d in (train_data, val_data, test_data):
-        for p in postprocess:
-            p(d)
-
-    return train_data, val_data, test_data, PHI
+    return n_train, n_val, n_test
+
+
+def trajectory_seeds(args):
+    # one seed per trajectory, so the data does not depend on how it is split over workers
+    seed_seq = np.random.SeedSequence(args.seed)
+    args.seed = seed_seq.entropy
+
+    # the measurement and SVD noise are drawn by torch in this process
+    if args.noise_seed is None:
+        args.noise_seed = int(seed_seq.generate_state(1)[0])
+    torch.manual_seed(args.noise_seed)
+
+    return seed_seq.spawn(args.n_trajectories)
+
+
+class Checkpoint:
+    '''Records the progress of a run in a directory: the number of finished
+    trajectories, the state of the torch RNG and whatever else the run needs
+    to carry on, plus (optionally) the finished examples themselves, in one
+    file per checkpoint.
+
+    Checkpoints are only taken every `every` trajectories, rounded up to a
+    whole number of batches, so that a resumed run integrates the same batches.'''
+
+    def __init__(self, path, args):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        bs = max(1, args.batch_size)
+        self.every = -(-args.checkpoint_every // bs) * bs
+        self.chunks = []
+        self.n_saved = 0
+
+    def due(self, n_done):
+        return self.every > 0 and n_done % self.every == 0
+
+    def save(self, args, n_done, examples=(), **state):
+        if examples:
+            name = f"examples-{len(self.chunks):05d}.pkl"
+            dump_atomic(list(examples), self.path / name)
+            self.chunks.append(name)
+
+        dump_atomic(
+            {
+                "args": {k: vars(args)[k] for k in _RESUME_ARGS + ("seed", "noise_seed")},
+                "n_done": n_done,
+                "chunks": self.chunks,
+                "torch_rng": torch.get_rng_state(),
+                **state
+            }, self.path / CHECKPOINT_NAME)
+        self.n_saved = n_done
+
+    def load(self, args):
+        '''Reads the last checkpoint and takes over its seeds into args.'''
+        checkpoint_path = self.path / CHECKPOINT_NAME
+        if not checkpoint_path.exists():
+            raise Exception(f"No checkpoint to resume from in {self.path}.")
+
+        with open(checkpoint_path, 'rb') as f:
+            state = pickle.load(f)
+
+        saved_args = state.pop("args")
+        for k in _RESUME_ARGS + ("seed", "noise_seed"):
+            if k in _RESUME_ARGS or vars(args)[k] is not None:
+                if vars(args)[k] != saved_args[k]:
+                    raise Exception(
+                        f"Cannot resume: {k} differs from the checkpointed run.")
+
+        args.seed = saved_args["seed"]
+        args.noise_seed = saved_args["noise_seed"]
+        self.chunks = state.pop("chunks")
+        self.n_saved = state["n_done"]
+
+        return state
+
+    def load_examples(self):
+        examples = []
+        for name in self.chunks:
+            with open(self.path / name, 'rb') as f:
+                examples.extend(pickle.load(f))
+
+        return examples
+
+    def remove(self):
+        for name in self.chunks + [CHECKPOINT_NAME]:
+            (self.path / name).unlink(missing_ok=True)
+
+        if not any(self.path.iterdir()):
+            self.path.rmdir()
+
+
+def start_run(args, checkpoint: Checkpoint = None):
+    '''Returns the trajectory seeds and, when resuming, the checkpoint state.'''
+    state = checkpoint.load(args) if args.resume else None
+    seeds = trajectory_seeds(args)
+
+    if state is not None:
+        torch.set_rng_state(state.pop("torch_rng"))
+
+    return seeds, state
+
+
+class SnapshotSVD:
+    '''Left singular vectors and singular values of the snapshot matrix
+    [Y_1^T + E_1, Y_2^T + E_2, ...], with one column per time sample of the
+    selected locations and E_k Gaussian noise of standard deviation
+    noise_std. Only the N x N Gram matrix is kept, updated per trajectory.'''
+
+    def __init__(self, num_locations, noise_std):
+        self.num_locations = num_locations  # ratio of the locations used
+        self.noise_std = noise_std
+        self.gram = None
+        self.n_snapshots = 0
+
+    def add(self, y_full):
+        y = torch.as_tensor(y_full, dtype=torch.float64)
+
+        if self.gram is None:
+            self.selected_indices = torch.linspace(
+                0, y.shape[1] - 1,
+                steps=int(y.shape[1] * self.num_locations)).long()
+            n = len(self.selected_indices)
+            self.gram = torch.zeros((n, n), dtype=torch.float64)
+
+        snapshots = y[:, self.selected_indices].T
+        snapshots = snapshots + self.noise_std * torch.randn_like(snapshots)
+
+        self.gram += snapshots @ snapshots.T
+        self.n_snapshots += y.shape[0]
+
+    def compute(self):
+        '''Returns (PHI, S), as the reduced SVD of the snapshot matrix would.'''
+        eigvals, eigvecs = torch.linalg.eigh(self.gram)
+        rank = min(len(eigvals), self.n_snapshots)
+
+        # eigh sorts in ascending order
+        S = eigvals.flip(0)[:rank].clamp(min=0.).sqrt()
+        PHI = eigvecs.flip(1)[:, :rank]
+
+        return PHI.to(torch.get_default_dtype()), S.to(torch.get_default_dtype())
+
+
+def report_spectrum(S):
+    energy = torch.cumsum(S**2, 0) / torch.sum(S**2)
+    print(f"Leading singular values: {S[:5].tolist()}")
+    for level in (0.99, 0.999, 0.9999):
+        n_modes = min(int(torch.searchsorted(energy, level)) + 1, len(S))
+        print(f"{n_modes} modes capture {100 * level:g}% of the energy")
+
+
+def make_raw_dataset(args, trajectory_sampler: TrajectorySampler, examples,
+                     postprocess=[]):
+    data = RawTrajectoryDataset(examples,
+                                *trajectory_sampler.dims(),
+                                delta=trajectory_sampler._delta,
+                                output_mask=trajectory_sampler._dyn.mask,
+                                input_mask=trajectory_sampler._dyn.input_mask,
+                                noise_std=args.noise_std)
+
+    for p in postprocess:
+        p(data)
+
+    return data
+
+
+def generate(args, trajectory_sampler: TrajectorySampler, postprocess=[],
+             checkpoint: Checkpoint = None):
+    n_train, n_val, n_test = split_sizes(args)
+    seeds, state = start_run(args, checkpoint)
+
+    if state is None:
+        n_done = 0
+        svd = SnapshotSVD(args.num_locations_svd, args.noise_std_svd)
+        examples = []
+    else:
+        n_done, svd = state["n_done"], state["svd"]
+        examples = checkpoint.load_examples()
+
+    for k, example in enumerate(iter_examples(args, trajectory_sampler, seeds,
+                                              start=n_done,
+                                              n_full_state=n_train),
+                                start=n_done):
+        y_full = example.pop("full_state")
+        if k < n_train:
+            svd.add(y_full)
+
+        examples.append(example)
+
+        if checkpoint is not None and checkpoint.due(k + 1):
+            checkpoint.save(args, k + 1, examples[checkpoint.n_saved:], svd=svd)
+
+    train_data = examples[:n_train]
+    val_data = examples[n_train:n_train + n_val]
+    test_data = examples[n_train + n_val:]
+
+    PHI, S = svd.compute()
+    report_spectrum(S)
+
+    train_data, val_data, test_data = (
+        make_raw_dataset(args, trajectory_sampler, d, postprocess)
+        for d in (train_data, val_data, test_data))
+
+    return train_data, val_data, test_data, PHI, S
+
+
+def generate_sharded(args, trajectory_sampler: TrajectorySampler,
+                     writer: ShardWriter, checkpoint: Checkpoint = None):
+    '''Like generate, but hands every trajectory to writer as soon as it is
+    sampled instead of keeping the splits in memory. Returns PHI and the
+    singular values.'''
+    n_train, n_val, n_test = split_sizes(args)
+    seeds, state = start_run(args, checkpoint)
+    splits = ["train"] * n_train + ["val"] * n_val + ["test"] * n_test
+
+    if state is None:
+        n_done = 0
+        svd = SnapshotSVD(args.num_locations_svd, args.noise_std_svd)
+    else:
+        n_done, svd = state["n_done"], state["svd"]
+        writer.load_state_dict(state["writer"])
+
+    for k, (split, example) in enumerate(zip(
+            splits[n_done:],
+            iter_examples(args, trajectory_sampler, seeds, start=n_done,
+                          n_full_state=n_train)),
+                                         start=n_done):
+        y_full = example.pop("full_state")
+        if split == "train":
+            svd.add(y_full)
+
+        writer.add(split, example)
+
+        # the shards already written serve as the checkpointed examples
+        if checkpoint is not None and checkpoint.due(k + 1):
+            checkpoint.save(args, k + 1, svd=svd, writer=writer.state_dict())
+
+    PHI, S = svd.compute()
+    report_spectrum(S)
+
+    return PHI, S
 
 
 def make_trajectory_sampler(settings):
@@ -165,6 +495,7 @@ def make_trajectory_sampler(settings):
                                 control_delta=settings["control_delta"],
                                 control_generator=sequence_generator,
                                 method=settings.get("method"),
-                                initial_state_generator=init_state_gen)
+                                initial_state_generator=init_state_gen,
+                                segmented=settings.get("segmented", False))
 
     return sampler
@@ -7,7 +7,8 @@ from pathlib import Path
 
 from scipy.signal import find_peaks
 
-from generate_data import parse_args, generate, make_trajectory_sampler
+from generate_data import parse_args, generate, generate_sharded, make_raw_dataset, make_trajectory_sampler, Checkpoint
+from RHYME_XT.shards import ShardWriter
 
 
 def main():
@@ -18,12 +19,35 @@ def main():
 
     sampler = make_trajectory_sampler(settings)
     postprocess = get_postprocess(settings["dynamics"]["name"])
-    
-    train_data, val_data, test_data, PHI = generate(args,
+
+    output_dir = Path("./data/")
+    output_dir.mkdir(exist_ok=True)
+
+    locations = torch.tensor(sampler._dyn.locations,dtype=torch.get_default_dtype()) if isinstance(sampler._dyn.locations, np.ndarray) else None
+
+    if args.shard_size > 0:
+        # Write the trajectories to disk while they are generated
+        writer = ShardWriter(
+            output_dir.joinpath(args.output_name), args.shard_size,
+            lambda examples: make_raw_dataset(args, sampler, examples,
+                                              postprocess))
+        checkpoint = Checkpoint(output_dir.joinpath(args.output_name), args)
+        PHI, S = generate_sharded(args, sampler, writer, checkpoint)
+        writer.close(settings=settings,
+                     args=vars(args),
+                     PHI=PHI,
+                     singular_values=S,
+                     Locations=locations)
+        checkpoint.remove()
+        return
+
+    checkpoint = Checkpoint(
+        output_dir.joinpath(args.output_name + ".checkpoint"), args)
+    train_data, val_data, test_data, PHI, S = generate(args,
                                                sampler,
-                                               postprocess=postprocess) 
+                                               postprocess=postprocess,
+                                               checkpoint=checkpoint) 
     
-    locations = torch.tensor(sampler._dyn.locations,dtype=torch.get_default_dtype()) if isinstance(sampler._dyn.locations, np.ndarray) else None
     data = {
         "train": train_data,
         "val": val_data,
@@ -31,15 +55,14 @@ def main():
         "settings": settings,
         "args": vars(args),
         "PHI": PHI,
+        "singular_values": S,
         "Locations":  locations,
     }
 
-    output_dir = Path("./data/")
-    output_dir.mkdir(exist_ok=True)
-
     # Write to disk
     with open(output_dir.joinpath(args.output_name + ".pkl"), 'wb') as f:
         pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    checkpoint.remove()
 
 
 def get_postprocess(dynamics: str):
@@ -4,7 +4,11 @@ from torch.utils.data import DataLoader
 import pickle, yaml
 from pathlib import Path
 from RHYME_XT import print_gpu_info, TrajectoryDataset, TrunkNet,RHYME_XT_Model
-from RHYME_XT.train import EarlyStopping, train_step, validate
+from RHYME_XT.train import EarlyStopping, train_step, validate, pack_collate
+from RHYME_XT.shards import load_sharded
+from RHYME_XT.arrays import load_arrays, is_arrays_dir
+from RHYME_XT.cache import cached_dataset, data_digest
+from RHYME_XT.batching import BucketBatchSampler, padding_efficiency
 from RHYME_XT.utils import trajectory,plot_space_time_trajectory
 from argparse import ArgumentParser
 import time
@@ -22,6 +26,8 @@ hyperparams = {
     'decoder_size': 1,
     'decoder_depth': 3,
     'batch_size': 64,
+    'bucket_pool_batches': 50,              # Batches drawn together and grouped by sequence length, 0: plain random batches
+    'num_workers': 4,                       # DataLoader worker processes that build and pack the batches, 0: in the training loop
     'unfreeze_epoch':1000,                  # From this epoch onwards, trunk svd net will learn during online training
     'use_nonlinear':True,                   # True: Nonlinearity, False: Inner product
     'NL_size':[50,50],                      # Hidden size of nonlinearity at end
@@ -35,6 +41,8 @@ hyperparams = {
     'lr': 0.00011614090101177696,
     'max_seq_len': 20,                      # Maximum sequence length used for training, -1 for full sequences
     'n_samples': 4,                         # Number of samples to use for training when max_seq_len is not -1
+    'lazy_windows': True,                   # True: build the RNN input of a window when it is loaded, False: all in memory up front
+    'window_seed': 0,                       # Seed of the training windows and the noise, also part of the dataset cache key
     'n_epochs': 100,                        # Number of epochs to train complete model for
     'n_epochs_trunk': 100000,               # Number of epochs to train trunk model for (only used if no pretrained trunk is given)
     'es_patience': 10,
@@ -183,27 +191,56 @@ def main():
                     type=str,
                     default=False,
                     help="Path to pretrained model, if a model is given it will used to initialize the new model with. Hyperparameters must match.")
+
+    ap.add_argument('--cache_dir',
+                    type=str,
+                    default="./data/cache",
+                    help="Directory in which the processed datasets are cached, keyed by the data and the settings.")
+
+    ap.add_argument('--no_cache',
+                    action='store_true',
+                    help="Always process the datasets, without reading or writing the cache.")
     
     sys_args = ap.parse_args()
     data_path = Path(sys_args.load_path)
     run = wandb.init(project='RHYME-XT', name=sys_args.name, config=hyperparams)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    with data_path.open('rb') as f:
-        data = pickle.load(f)
+    if is_arrays_dir(data_path): # written by convert_data.py, memory-mapped
+        data = load_arrays(data_path)
+    elif data_path.is_dir(): # written in shards by semble_generate.py --shard_size
+        data = load_sharded(data_path)
+    else:
+        with data_path.open('rb') as f:
+            data = pickle.load(f)
+
+    lazy = wandb.config['lazy_windows']
+    digest = None if sys_args.no_cache else data_digest(data_path)
+
+    def make_dataset(split, **settings):
+        # every split gets its own seed
+        settings.update(lazy=lazy, seed=[wandb.config['window_seed'], ("train", "val", "test").index(split)])
+        build = lambda: TrajectoryDataset(data[split], **settings)
+        if digest is None:
+            return build()
+
+        t_start = time.time()
+        dataset, hit = cached_dataset(sys_args.cache_dir, digest, build, split=split, **settings)
+        print(f"{split} data {'loaded from' if hit else 'written to'} cache in {time.time() - t_start:.1f}s")
+        return dataset
 
     ### Noise settings ###
     if sys_args.reset_noise == True:
         print("add noise to IC and output with STD:",sys_args.noise_std)
-        train_data = TrajectoryDataset(data["train"],max_seq_len=wandb.config['max_seq_len'],n_samples=wandb.config['n_samples'],noise_std=sys_args.noise_std)
-        val_data = TrajectoryDataset(data["val"],noise_std=sys_args.noise_std)
+        train_data = make_dataset("train",max_seq_len=wandb.config['max_seq_len'],n_samples=wandb.config['n_samples'],noise_std=sys_args.noise_std)
+        val_data = make_dataset("val",noise_std=sys_args.noise_std)
     else:   
         print("No noise")
-        train_data = TrajectoryDataset(data["train"],max_seq_len=wandb.config['max_seq_len'],n_samples=wandb.config['n_samples'])
-        val_data = TrajectoryDataset(data["val"])
+        train_data = make_dataset("train",max_seq_len=wandb.config['max_seq_len'],n_samples=wandb.config['n_samples'])
+        val_data = make_dataset("val")
 
     # Don't add noise to test data
-    test_data = TrajectoryDataset(data["test"])
+    test_data = make_dataset("test")
 
     ### Select locations for training ###
     scaling = wandb.config['location_scaling'] # scale locations values
@@ -368,9 +405,24 @@ def main():
                                es_delta=wandb.config['es_delta'])
 
     bs = wandb.config['batch_size']
-    train_dl = DataLoader(train_data, batch_size=bs, shuffle=True)
-    val_dl = DataLoader(val_data, batch_size=bs, shuffle=True)
-    test_dl = DataLoader(test_data, batch_size=bs, shuffle=True)
+    n_workers = wandb.config['num_workers']
+
+    def make_loader(dataset):
+        if n_workers > 0:
+            dataset.share_memory() # the workers use the same tensors, not copies
+
+        # batches padded to their longest window and packed in the workers, kept alive between epochs
+        loader_args = dict(collate_fn=pack_collate, num_workers=n_workers, persistent_workers=n_workers > 0,
+                           pin_memory=torch.cuda.is_available())
+        if wandb.config['bucket_pool_batches'] == 0:
+            return DataLoader(dataset, batch_size=bs, shuffle=True, **loader_args)
+
+        sampler = BucketBatchSampler(dataset.seq_lens, bs, pool_batches=wandb.config['bucket_pool_batches'])
+        return DataLoader(dataset, batch_sampler=sampler, **loader_args)
+
+    train_dl = make_loader(train_data)
+    val_dl = make_loader(val_data)
+    test_dl = make_loader(test_data)
 
     header_msg = f"{'Epoch':>5} :: {'Total Loss (Train)':>16} :: {'Data Loss (Train)':>16} :: {'Orthogonal Loss (Train)':>16} :: " \
         f"{'Data Loss (Val)':>16} :: {'Data Loss (Test)':>16} :: {'Best (Val)':>16}"
@@ -394,6 +446,11 @@ def main():
             f"{0:>5d} :: {train_loss_total:>16e} :: {train_loss_data:>16e} :: {train_loss_ortho:>16e} :: " \
             f"{val_loss_data:>16e} :: {test_loss_data:>16e}  :: {early_stop.best_val_loss:>16e}"
     )
+    if wandb.config['bucket_pool_batches'] != 0:
+        random_efficiency = padding_efficiency(train_data.seq_lens, torch.randperm(len(train_data)).split(bs))
+        print(f"Padding efficiency of the training batches: {train_dl.batch_sampler.efficiency:.3f} "
+              f"(random batches: {random_efficiency:.3f})")
+        run.summary["RHYME-XT/padding_efficiency_random"] = random_efficiency
     start = time.time()
 
     ### Main training loop ###
@@ -442,6 +499,9 @@ def main():
             fig = plot_space_time_trajectory(y,y_pred,time_indices=time_indices,space_indices=space_indices)
             wandb.log({"RHYME-XT/Test trajectory": wandb.Image(fig),"RHYME-XT/Best_epoch": epoch+1})
 
+        if wandb.config['bucket_pool_batches'] != 0:
+            wandb.log({'RHYME-XT/padding_efficiency': train_dl.batch_sampler.efficiency}, commit=False)
+
         wandb.log({
             'RHYME-XT/time': time.time() - start,
             'RHYME-XT/epoch': epoch + 1,
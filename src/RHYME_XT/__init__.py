@@ -1,4 +1,4 @@
 from .model import TrunkNet, FFNet,RHYME_XT_Model
-from .trajectory import TrajectoryDataset, RawTrajectoryDataset
+from .trajectory import TrajectoryDataset, RawTrajectoryDataset, pad_collate
 from .train import validate
 from .utils import get_arg_parser, pack_model_inputs, print_gpu_info
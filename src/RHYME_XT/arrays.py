@@ -0,0 +1,40 @@
+import pickle
+from pathlib import Path
+
+from .trajectory import RawTrajectoryDataset
+
+METADATA_NAME = "metadata.pkl"
+SPLITS = ("train", "val", "test")
+
+
+def save_arrays(data: dict, path):
+    '''Writes a data dictionary (as produced by semble_generate.py) to a
+    directory, with every split as a RawTrajectoryDataset array layout and the
+    remaining entries in one metadata file.'''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    for split in SPLITS:
+        data[split].save_arrays(path / split)
+
+    metadata = {k: v for (k, v) in data.items() if k not in SPLITS}
+    with open(path / METADATA_NAME, 'wb') as f:
+        pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_arrays(path, mmap=True):
+    '''Loads a directory written by save_arrays. With mmap, the trajectories
+    are memory-mapped, so loading does not read them and processes loading
+    the same directory share the page cache.'''
+    path = Path(path)
+    with open(path / METADATA_NAME, 'rb') as f:
+        data = pickle.load(f)
+
+    for split in SPLITS:
+        data[split] = RawTrajectoryDataset.load_arrays(path / split, mmap)
+
+    return data
+
+
+def is_arrays_dir(path):
+    return (Path(path) / METADATA_NAME).exists()
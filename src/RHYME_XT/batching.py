@@ -0,0 +1,63 @@
+import torch
+from torch.utils.data import Sampler
+
+
+def padding_efficiency(lengths, batches):
+    '''Fraction of the RNN inputs of the batches, each padded to its longest
+    sequence, that is not padding.'''
+    used, padded = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        used += int(batch_lengths.sum())
+        padded += len(batch) * int(batch_lengths.max())
+
+    return used / padded if padded else 1.
+
+
+class BucketBatchSampler(Sampler):
+    '''Batches of indices of sequences with similar lengths, for a DataLoader's
+    batch_sampler.
+
+    Every epoch the indices are shuffled and split into pools of pool_batches
+    batches (one pool if None). Each pool is sorted by length, with sequences
+    of the same length kept in random order, and cut into batches, which are
+    then yielded in random order. efficiency is the padding_efficiency of the
+    batches of the last epoch.'''
+
+    def __init__(self, lengths, batch_size, pool_batches=50, drop_last=False,
+                 generator=None):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.pool_batches = pool_batches
+        self.drop_last = drop_last
+        self.generator = generator
+        self.efficiency = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+
+        return -(-len(self.lengths) // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.lengths)
+        if n == 0:
+            return
+
+        perm = torch.randperm(n, generator=self.generator)
+        pool_size = n if not self.pool_batches else self.pool_batches * self.batch_size
+
+        # stable sort, so sequences of the same length stay shuffled
+        order = torch.cat([
+            pool[torch.sort(self.lengths[pool], stable=True).indices]
+            for pool in perm.split(pool_size)
+        ])
+
+        batches = list(order.split(self.batch_size))
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        self.efficiency = padding_efficiency(self.lengths, batches)
+
+        for k in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[k].tolist()
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+from .shards import dump_atomic
+from .trajectory import TrajectoryDataset
+
+# bump when TrajectoryDataset processes the trajectories differently, so that
+# the entries written before are not used anymore
+CACHE_VERSION = 1
+ENTRY_NAME = "entry.pkl"
+
+
+def _digest_file(path: Path, h):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            h.update(chunk)
+
+
+def data_digest(path):
+    '''Hash of the content of a data file, or of all files of a data
+    directory (sharded or converted to arrays) with their relative names.'''
+    path = Path(path)
+    h = hashlib.blake2b(digest_size=20)
+
+    if not path.is_dir():
+        _digest_file(path, h)
+        return h.hexdigest()
+
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        if file.suffix == ".tmp":  # unfinished writes
+            continue
+        h.update(file.relative_to(path).as_posix().encode() + b'\0')
+        _digest_file(file, h)
+
+    return h.hexdigest()
+
+
+def cache_key(digest, **settings):
+    '''Name of the cache entry of the dataset built with settings from the
+    data with the given digest.'''
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((CACHE_VERSION, digest, sorted(settings.items()))).encode())
+
+    return h.hexdigest()
+
+
+def _checksums(path: Path):
+    checksums = {}
+    for file in sorted(path.iterdir()):
+        if file.name != ENTRY_NAME:
+            h = hashlib.blake2b(digest_size=20)
+            _digest_file(file, h)
+            checksums[file.name] = h.hexdigest()
+
+    return checksums
+
+
+def load_cached(path, key, mmap=True):
+    '''Loads the entry key of the cache directory path, or returns None if
+    it is missing, incomplete or its files do not match their checksums.'''
+    entry_path = Path(path) / key
+
+    try:
+        with open(entry_path / ENTRY_NAME, 'rb') as f:
+            entry = pickle.load(f)
+
+        if entry["key"] != key or _checksums(entry_path) != entry["checksums"]:
+            return None
+
+        return TrajectoryDataset.load_arrays(entry_path, mmap)
+    except (OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def store_cached(path, key, dataset: TrajectoryDataset, **settings):
+    '''Writes dataset as the entry key of the cache directory path, replacing
+    an existing entry. The entry is written to a temporary directory and
+    renamed, so other processes never see a partial one.'''
+    path = Path(path)
+    entry_path = path / key
+    tmp_path = path / f"{key}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    dataset.save_arrays(tmp_path)
+    # written last: an entry without it is incomplete
+    dump_atomic(
+        {
+            "key": key,
+            "version": CACHE_VERSION,
+            "settings": settings,
+            "checksums": _checksums(tmp_path)
+        }, tmp_path / ENTRY_NAME)
+
+    shutil.rmtree(entry_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        # another process has just written the same entry
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def cached_dataset(path, digest, build, mmap=True, **settings):
+    '''Returns the TrajectoryDataset cached in the directory path for the data
+    with the given digest and settings, or the one returned by build() after
+    storing it there if it is not cached or the entry is corrupt. settings
+    must hold everything that build depends on besides the data. The second
+    return value tells whether the dataset was loaded from the cache.'''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    key = cache_key(digest, **settings)
+
+    dataset = load_cached(path, key, mmap)
+    if dataset is not None:
+        return dataset, True
+
+    dataset = build()
+    store_cached(path, key, dataset, **settings)
+
+    return dataset, False
@@ -0,0 +1,98 @@
+import os
+import pickle
+from pathlib import Path
+
+from .trajectory import RawTrajectoryDataset
+
+MANIFEST_NAME = "manifest.pkl"
+
+
+def dump_atomic(obj, path: Path):
+    # write to a temporary file first, so a crash never leaves a partial file behind
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter:
+    '''Writes the trajectories of each data split to disk in shards of a
+    fixed number of trajectories, as they are added.
+
+    make_shard turns a list of examples into the object that is pickled,
+    e.g. a RawTrajectoryDataset. close() writes a manifest listing the
+    shards together with any metadata.'''
+
+    def __init__(self, path, shard_size, make_shard,
+                 splits=("train", "val", "test")):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self._make_shard = make_shard
+
+        self._buffers = {split: [] for split in splits}
+        self.shards = {split: [] for split in splits}
+        self.n_trajectories = {split: 0 for split in splits}
+
+    def add(self, split, example):
+        self._buffers[split].append(example)
+
+        if len(self._buffers[split]) >= self.shard_size:
+            self.flush(split)
+
+    def flush(self, split):
+        examples = self._buffers[split]
+        name = f"{split}-{len(self.shards[split]):05d}.pkl"
+        dump_atomic(self._make_shard(examples), self.path / name)
+
+        self.shards[split].append(name)
+        self.n_trajectories[split] += len(examples)
+        self._buffers[split] = []
+
+    def state_dict(self):
+        '''The shards written so far and the buffered examples, so that
+        writing can be resumed with load_state_dict.'''
+        return {
+            "buffers": self._buffers,
+            "shards": self.shards,
+            "n_trajectories": self.n_trajectories
+        }
+
+    def load_state_dict(self, state):
+        self._buffers = state["buffers"]
+        self.shards = state["shards"]
+        self.n_trajectories = state["n_trajectories"]
+
+    def close(self, **metadata):
+        for split, examples in self._buffers.items():
+            # every split gets at least one (possibly empty) shard
+            if examples or not self.shards[split]:
+                self.flush(split)
+
+        manifest = {
+            "shards": self.shards,
+            "n_trajectories": self.n_trajectories,
+            **metadata
+        }
+        dump_atomic(manifest, self.path / MANIFEST_NAME)
+
+        return manifest
+
+
+def load_sharded(path):
+    '''Loads a directory written by ShardWriter into a dictionary with the
+    same layout as a single data file: the manifest metadata plus one
+    RawTrajectoryDataset per split.'''
+    path = Path(path)
+    with open(path / MANIFEST_NAME, 'rb') as f:
+        data = pickle.load(f)
+
+    for split, names in data["shards"].items():
+        shards = []
+        for name in names:
+            with open(path / name, 'rb') as f:
+                shards.append(pickle.load(f))
+
+        data[split] = RawTrajectoryDataset.concat(shards)
+
+    return data
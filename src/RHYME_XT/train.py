@@ -1,7 +1,12 @@
 import torch
+from torch.nn.utils.rnn import PackedSequence
 
+from .trajectory import pad_collate
 
-def prep_inputs(x0, y, u, lengths, device):
+
+def pack_batch(x0, y, u, lengths):
+    '''Sorts a batch by decreasing length and packs the RNN inputs u. Returns
+    (x0, y, u, deltas) as prep_inputs does, but on the CPU.'''
     sort_idxs = torch.argsort(lengths, descending=True)
     x0 = x0[sort_idxs]
     y = y[sort_idxs]
@@ -15,6 +20,18 @@ def prep_inputs(x0, y, u, lengths, device):
                                                 batch_first=True,
                                                 enforce_sorted=True)
 
+    return x0, y, u, deltas
+
+
+def pack_collate(batch):
+    '''Collates TrajectoryDataset examples into a packed batch (see pack_batch),
+    so that DataLoader workers rather than the training loop do the packing.'''
+    return pack_batch(*pad_collate(batch))
+
+
+def prep_inputs(x0, y, u, lengths, device):
+    x0, y, u, deltas = pack_batch(x0, y, u, lengths)
+
     x0 = x0.to(device)
     y = y.to(device)
     u = u.to(device)
@@ -23,13 +40,22 @@ def prep_inputs(x0, y, u, lengths, device):
     return x0, y, u, deltas
 
 
+def load_batch(example, device):
+    '''Moves a batch to device, packing it first unless pack_collate did.'''
+    if not isinstance(example[2], PackedSequence):
+        return prep_inputs(*example, device)
+
+    # non_blocking copies from pinned memory overlap with compute
+    return tuple(x.to(device, non_blocking=True) for x in example)
+
+
 def validate(data,locations_out,locations_in,loss_fn, model, device,selected_indices=None):
     vl = 0.
     data_loss_total = 0.
 
     with torch.no_grad():
         for example in data:
-            x0, y, u, deltas = prep_inputs(*example, device)
+            x0, y, u, deltas = load_batch(example, device)
             y_pred, basis_functions = model(x0, u, locations_out.to(device), deltas, locations_in.to(device))
             if selected_indices is None:
                 y_subset = y # use all y values if no indices are specified
@@ -41,7 +67,7 @@ def validate(data,locations_out,locations_in,loss_fn, model, device,selected_ind
     return vl / len(data), data_loss_total / len(data)
 
 def train_step(example,locations_out,locations_in, loss_fn, model, optimizer, device,selected_indices=None):
-    x0, y, u, deltas = prep_inputs(*example, device)
+    x0, y, u, deltas = load_batch(example, device)
     optimizer.zero_grad()
 
     y_pred, basis_functions = model(x0, u, locations_out.to(device), deltas, locations_in.to(device))
@@ -1,6 +1,52 @@
 import numpy as np
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
+import pickle
+from pathlib import Path
+
+ARRAYS_META_NAME = "meta.pkl"
+
+
+def _save_tensor(path: Path, name, tensor):
+    np.save(path / f"{name}.npy", tensor.numpy())
+
+
+def _load_tensor(path: Path, name, mmap):
+    # copy-on-write mapping: pages are shared between processes until written to
+    return torch.from_numpy(
+        np.load(path / f"{name}.npy", mmap_mode='c' if mmap else None))
+
+
+def _save_ragged(path: Path, name, tensors, dim):
+    '''Saves a list of (T_k, dim) tensors (or (T_k, ) if dim is None) as one concatenated array plus
+    offsets.'''
+    flat = torch.cat(tensors) if tensors else torch.empty((0, ) if dim is None else (0, dim))
+    offsets = np.cumsum([0] + [len(x) for x in tensors])
+    _save_tensor(path, name, flat)
+    np.save(path / f"{name}_offsets.npy", offsets)
+
+
+def _load_ragged(path: Path, name, mmap):
+    flat = _load_tensor(path, name, mmap)
+    lengths = np.diff(np.load(path / f"{name}_offsets.npy")).tolist()
+
+    # views into the flat tensor, no copies
+    return list(torch.split(flat, lengths)) if lengths else []
+
+
+def _share_ragged(tensors):
+    # one shared block for the whole list, rather than one per tensor
+    if not tensors:
+        return tensors
+
+    flat = torch.cat(tensors).share_memory_()
+    return list(torch.split(flat, [len(x) for x in tensors]))
+
+
+def _control_index(t, idxs, delta, init_time=0.):
+    # index of the control step that contains each of the times t[idxs]
+    return torch.floor((t.reshape(-1)[idxs] - init_time) / delta).long()
 
 
 class RawTrajectoryDataset(Dataset):
@@ -35,6 +81,7 @@ class RawTrajectoryDataset(Dataset):
         self.state = []
         self.state_noise = []
         self.control_seq = []
+        self.control_holds = []  # control_seq[k][j] holds for control_holds[k][j] control steps
 
         for k, sample in enumerate(data):
             self.init_state[k] = torch.from_numpy(sample["init_state"].reshape(
@@ -53,10 +100,89 @@ class RawTrajectoryDataset(Dataset):
                              std=noise_std,
                              size=self.state[-1].size()))
             
+            # compact (PiecewiseConstant) controls are kept as their values and holds
+            u = sample['control']
+            holds = getattr(u, "holds", None)
             self.control_seq.append(
-                torch.from_numpy(sample['control']).type(
+                torch.from_numpy(getattr(u, "values", u)).type(
                     torch.get_default_dtype()).reshape((-1, self.control_dim)))
-            
+            self.control_holds.append(
+                torch.ones(len(self.control_seq[-1]), dtype=torch.long)
+                if holds is None else torch.from_numpy(holds).long())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # datasets pickled before the controls had holds
+        if "control_holds" not in state:
+            self.control_holds = [
+                torch.ones(len(u), dtype=torch.long) for u in self.control_seq
+            ]
+
+    @classmethod
+    def concat(cls, datasets):
+        '''Joins datasets with the same dimensions and settings into one.'''
+        data = cls.__new__(cls)
+        data.__dict__.update(datasets[0].__dict__)
+
+        data.init_state = torch.cat([d.init_state for d in datasets])
+        data.init_state_noise = torch.cat(
+            [d.init_state_noise for d in datasets])
+        data.time = [t for d in datasets for t in d.time]
+        data.state = [y for d in datasets for y in d.state]
+        data.state_noise = [y_n for d in datasets for y_n in d.state_noise]
+        data.control_seq = [u for d in datasets for u in d.control_seq]
+        data.control_holds = [h for d in datasets for h in d.control_holds]
+
+        return data
+
+    def save_arrays(self, path):
+        '''Writes the dataset as .npy arrays, which load_arrays can memory-map.
+        The trajectories are concatenated and indexed by offsets.'''
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        _save_tensor(path, "init_state", self.init_state)
+        _save_tensor(path, "init_state_noise", self.init_state_noise)
+        _save_ragged(path, "time", self.time, 1)
+        _save_ragged(path, "state", self.state, self.state_dim)
+        _save_ragged(path, "state_noise", self.state_noise, self.state_dim)
+        _save_ragged(path, "control_seq", self.control_seq, self.control_dim)
+        _save_ragged(path, "control_holds", self.control_holds, None)
+
+        ragged = ("init_state", "init_state_noise", "time", "state",
+                  "state_noise", "control_seq", "control_holds")
+        meta = {k: v for (k, v) in self.__dict__.items() if k not in ragged}
+        with open(path / ARRAYS_META_NAME, 'wb') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load_arrays(cls, path, mmap=True):
+        '''Loads a dataset written by save_arrays. With mmap, the tensors are
+        backed by the files instead of being read into memory.'''
+        path = Path(path)
+        data = cls.__new__(cls)
+
+        with open(path / ARRAYS_META_NAME, 'rb') as f:
+            data.__dict__.update(pickle.load(f))
+
+        data.init_state = _load_tensor(path, "init_state", mmap)
+        data.init_state_noise = _load_tensor(path, "init_state_noise", mmap)
+        data.time = _load_ragged(path, "time", mmap)
+        data.state = _load_ragged(path, "state", mmap)
+        data.state_noise = _load_ragged(path, "state_noise", mmap)
+        data.control_seq = _load_ragged(path, "control_seq", mmap)
+
+        # written before the controls had holds
+        if (path / "control_holds.npy").exists():
+            data.control_holds = _load_ragged(path, "control_holds", mmap)
+        else:
+            data.control_holds = [
+                torch.ones(len(u), dtype=torch.long) for u in data.control_seq
+            ]
+
+        return data
+
     @classmethod
     def generate(cls, generator, time_horizon, n_trajectories, n_samples,
                  noise_std):
@@ -80,13 +206,30 @@ class RawTrajectoryDataset(Dataset):
                    generator=generator,
                    noise_std=noise_std)
 
+    def control(self, index):
+        '''The control of every control step of trajectory index.'''
+        u, holds = self.control_seq[index], self.control_holds[index]
+        if len(u) == int(holds.sum()):
+            return u
+
+        return torch.repeat_interleave(u, holds, dim=0)
+
     def __len__(self):
         return len(self.init_state)
 
     def __getitem__(self, index):
         return (self.init_state[index], self.init_state_noise[index],
                 self.time[index], self.state[index], self.state_noise[index],
-                self.control_seq[index])
+                self.control(index))
+
+
+def pad_collate(batch):
+    '''Collates TrajectoryDataset examples into a batch, with the RNN inputs
+    padded with zeros to the longest one in the batch.'''
+    init_state, state, rnn_input, seq_lens = zip(*batch)
+
+    return (torch.stack(init_state), torch.stack(state),
+            pad_sequence(rnn_input, batch_first=True), torch.stack(seq_lens))
 
 
 class TrajectoryDataset(Dataset):
@@ -95,99 +238,237 @@ class TrajectoryDataset(Dataset):
                  raw_data: RawTrajectoryDataset,
                  max_seq_len=-1,
                  n_samples=1,
-                 noise_std=0.):
-
+                 noise_std=0.,
+                 lazy=False,
+                 seed=None):
+        '''Windows of the trajectories of raw_data, from a start sample (or the
+        initial state if max_seq_len is -1) to an end sample.
+
+        With lazy, only the (trajectory, start, end) indices of the windows
+        are kept, together with the times and controls of raw_data, and the
+        RNN input of a window is built in __getitem__, trimmed to its length.
+        Batch those with pad_collate.
+
+        seed seeds the choice of the windows and the noise, which otherwise
+        come from fresh entropy and the global torch RNG.'''
         self.state_dim = raw_data.state_dim
         self.control_dim = raw_data.control_dim
         self.output_dim = raw_data.output_dim
         self.delta = raw_data.delta
+        self.lazy = lazy
 
-        mask = tuple(bool(v) for v in raw_data.mask)
+        mask = torch.tensor([bool(v) for v in raw_data.mask])
 
         init_state = []
         state = []
         rnn_input_data = []
         seq_len_data = []
+        windows = []
 
-        rng = np.random.default_rng()
-
-        k_tr = 0
-
-        for (x0, _, t, y, _, u) in raw_data:
-            y_n = torch.normal(mean=0.0, std=noise_std, size=y.shape)  # zero-mean Gaussian noise
-            x0_n = torch.normal(mean=0.0, std=noise_std, size=x0.shape)  # zero-mean Gaussian noise
+        if seed is None:
+            rng, noise_gen = np.random.default_rng(), None
+        else:
+            window_seq, noise_seq = np.random.SeedSequence(seed).spawn(2)
+            rng = np.random.default_rng(window_seq)
+            noise_gen = torch.Generator().manual_seed(
+                int(noise_seq.generate_state(1, np.uint64)[0]))
+
+        for k_tr in range(len(raw_data)):
+            # the controls as stored, compact or not
+            x0, t, y = (raw_data.init_state[k_tr], raw_data.time[k_tr],
+                        raw_data.state[k_tr])
+            u, holds = raw_data.control_seq[k_tr], raw_data.control_holds[k_tr]
+
+            y_n = torch.normal(mean=0.0, std=noise_std, size=y.shape, generator=noise_gen)  # zero-mean Gaussian noise
+            x0_n = torch.normal(mean=0.0, std=noise_std, size=x0.shape, generator=noise_gen)  # zero-mean Gaussian noise
             y += y_n
             x0 += x0_n
 
             if max_seq_len == -1:
-                for k_s, y_s in enumerate(y):
-                    rnn_input, rnn_input_len = self.process_example(
-                        0, k_s, t, u, self.delta)
-
-                    s = y_s.view(1, -1)[:, mask].reshape(-1)
-
-                    init_state.append(x0)
-                    state.append(s)
-                    seq_len_data.append(rnn_input_len)
-                    rnn_input_data.append(rnn_input)
-
+                # from the initial state to every sample
+                end_idxs = torch.arange(len(y))
+                start_idxs = torch.zeros_like(end_idxs)
+                init_state.append(x0.expand(len(y), -1))
             else:
-                for k_s, y_s in enumerate(y):
-                    # find index of last relevant state sample
-                    times = (t - t[k_s] - max_seq_len * self.delta)
-                    times[times > 0] = 0.
-                    k_l = times.argmax().item()
-                    if k_l == k_s:
-                        end_idxs = (0, )
-                    else:
-                        if k_l - k_s == -1:  # avoid -1
-                            break
-                        end_idxs = rng.choice(k_l - k_s,
-                                              size=min(n_samples, k_l - k_s),
-                                              replace=False)
-
-                    for k_e in end_idxs:
-                        rnn_input, rnn_input_len = self.process_example(
-                            k_s, k_s + k_e, t, u, self.delta)
-
-                        init_state.append(y_s)
-                        state.append(y[k_s + k_e, mask])
-                        seq_len_data.append(rnn_input_len)
-                        rnn_input_data.append(rnn_input)
-
-        self.init_state = torch.stack(init_state).type(
-            torch.get_default_dtype())
-        self.state = torch.stack(state).type(torch.get_default_dtype())
-        self.rnn_input = torch.stack(rnn_input_data).type(
-            torch.get_default_dtype())
-        self.seq_lens = torch.tensor(seq_len_data, dtype=torch.long)
-
-        self.len = len(init_state)
+                start_idxs, end_idxs = self._windows(t, max_seq_len,
+                                                     self.delta, n_samples,
+                                                     rng)
+                init_state.append(y[start_idxs])
+
+            state.append(y[end_idxs][:, mask])
+
+            if lazy:
+                windows.append(
+                    torch.stack((torch.full_like(start_idxs, k_tr),
+                                 start_idxs, end_idxs), dim=1))
+                seq_len_data.append(1 + _control_index(t, end_idxs, self.delta)
+                                    - _control_index(t, start_idxs, self.delta))
+            else:
+                rnn_input, rnn_input_len = self.process_examples(
+                    start_idxs, end_idxs, t, u, self.delta, holds)
+
+                seq_len_data.append(rnn_input_len)
+                rnn_input_data.append(rnn_input)
+
+        self.init_state = torch.cat(init_state).type(torch.get_default_dtype())
+        self.state = torch.cat(state).type(torch.get_default_dtype())
+        self.seq_lens = torch.cat(seq_len_data)
+
+        if lazy:
+            self.windows = torch.cat(windows)
+            # shared with raw_data, not copied
+            self.time = raw_data.time
+            self.control_seq = raw_data.control_seq
+            self.control_holds = raw_data.control_holds
+        else:
+            self.rnn_input = torch.cat(rnn_input_data).type(
+                torch.get_default_dtype())
+
+        self.len = len(self.init_state)
 
     @staticmethod
-    def process_example(start_idx, end_idx, t, u, delta):
-        init_time = 0.
+    def _windows(t, max_seq_len, delta, n_samples, rng):
+        '''Start and end sample indices of the windows: from every sample to
+        up to n_samples random later samples within max_seq_len control steps.'''
+        t = t.reshape(-1)
+
+        # index of the last relevant state sample of every start sample
+        times = t[None, :] - t[:, None] - max_seq_len * delta
+        times[times > 0] = 0.
+        last_idxs = times.argmax(dim=1).tolist()
+
+        start_idxs, end_idxs = [], []
+        for k_s, k_l in enumerate(last_idxs):
+            if k_l == k_s:
+                ends = (0, )
+            else:
+                if k_l - k_s == -1:  # avoid -1
+                    break
+                ends = rng.choice(k_l - k_s,
+                                  size=min(n_samples, k_l - k_s),
+                                  replace=False)
+
+            start_idxs.extend([k_s] * len(ends))
+            end_idxs.extend(k_s + k_e for k_e in ends)
+
+        return (torch.tensor(start_idxs, dtype=torch.long),
+                torch.tensor(end_idxs, dtype=torch.long))
+
+    def _array_names(self):
+        # the tensors and the (ragged) lists of per trajectory tensors
+        if self.lazy:
+            return (("init_state", "state", "seq_lens", "windows"),
+                    (("time", 1), ("control_seq", self.control_dim),
+                     ("control_holds", None)))
+
+        return ("init_state", "state", "rnn_input", "seq_lens"), ()
+
+    def save_arrays(self, path):
+        '''Writes the processed tensors as .npy arrays, see load_arrays.'''
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        tensors, ragged = self._array_names()
+        for name in tensors:
+            _save_tensor(path, name, getattr(self, name))
+        for name, dim in ragged:
+            _save_ragged(path, name, getattr(self, name), dim)
+
+        arrays = tensors + tuple(name for name, _ in ragged)
+        meta = {k: v for (k, v) in self.__dict__.items() if k not in arrays}
+        with open(path / ARRAYS_META_NAME, 'wb') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
 
-        u_start_idx = int(np.floor((t[start_idx] - init_time) / delta))
-        u_end_idx = int(np.floor((t[end_idx] - init_time) / delta))
-        u_sz = 1 + u_end_idx - u_start_idx
+    @classmethod
+    def load_arrays(cls, path, mmap=True):
+        '''Loads a dataset written by save_arrays, memory-mapped if mmap.'''
+        path = Path(path)
+        data = cls.__new__(cls)
+
+        with open(path / ARRAYS_META_NAME, 'rb') as f:
+            data.__dict__.update(pickle.load(f))
+        data.__dict__.setdefault("lazy", False)  # written before the lazy mode
+        data.memory_mapped = mmap
+
+        tensors, ragged = data._array_names()
+        for name in tensors:
+            setattr(data, name, _load_tensor(path, name, mmap))
+        for name, _ in ragged:
+            setattr(data, name, _load_ragged(path, name, mmap))
+
+        return data
+
+    def share_memory(self):
+        '''Moves the tensors to shared memory, so that DataLoader workers use
+        them without copies, also when they are started with spawn. A
+        memory-mapped dataset (see load_arrays) is shared through the page
+        cache already and left as it is. Returns self.'''
+        if getattr(self, "memory_mapped", False):
+            return self
+
+        tensors, ragged = self._array_names()
+        for name in tensors:
+            getattr(self, name).share_memory_()
+        for name, _ in ragged:
+            setattr(self, name, _share_ragged(getattr(self, name)))
+
+        return self
 
-        u_seq = torch.zeros_like(u)
-        u_seq[0:u_sz] = u[u_start_idx:(u_end_idx + 1)]
+    @staticmethod
+    def process_example(start_idx, end_idx, t, u, delta, holds=None):
+        '''Returns the controls from t[start_idx] to t[end_idx], padded to the
+        full control sequence, with the fraction of every control step that
+        falls in between, and the number of those control steps. If holds is
+        given, u[j] is held for holds[j] control steps.'''
+        rnn_input, u_sz = TrajectoryDataset.process_examples(
+            [start_idx], [end_idx], t, u, delta, holds)
 
-        deltas = torch.ones((u_seq.shape[0], 1))
-        t_u_end = init_time + delta * u_end_idx
-        t_u_start = init_time + delta * u_start_idx
+        return rnn_input[0], int(u_sz[0])
 
-        if u_sz > 1:
-            deltas[0] = (1. - (t[start_idx] - t_u_start) / delta).item()
-            deltas[u_sz - 1] = ((t[end_idx] - t_u_end) / delta).item()
-        else:
-            deltas[0] = ((t[end_idx] - t[start_idx]) / delta).item()
+    @staticmethod
+    def process_examples(start_idxs, end_idxs, t, u, delta, holds=None,
+                         n_rows=None):
+        '''process_example for the windows from t[start_idxs[k]] to
+        t[end_idxs[k]] at once. Returns the inputs (n_windows, n_rows,
+        control_dim + 1) and their lengths. n_rows defaults to the length of
+        the full control sequence.'''
+        init_time = 0.
+        t = t.reshape(-1)
+        start_idxs = torch.as_tensor(start_idxs, dtype=torch.long)
+        end_idxs = torch.as_tensor(end_idxs, dtype=torch.long)
+        t_start, t_end = t[start_idxs], t[end_idxs]
 
-        deltas[u_sz:] = 0.
+        u_start_idx = _control_index(t, start_idxs, delta, init_time)
+        u_end_idx = _control_index(t, end_idxs, delta, init_time)
+        u_sz = 1 + u_end_idx - u_start_idx
 
-        rnn_input = torch.hstack((u_seq, deltas))
+        # control step of every row, rows past the end of a window are zero
+        if n_rows is None:
+            n_rows = len(u) if holds is None else int(holds.sum())
+        rows = torch.arange(n_rows)
+        in_window = rows < u_sz[:, None]
+        steps = torch.where(in_window, u_start_idx[:, None] + rows, 0)
+        if holds is not None:
+            steps = torch.searchsorted(torch.cumsum(holds, 0), steps,
+                                       right=True)
+
+        u_seq = u[steps]
+        u_seq[~in_window] = 0.
+
+        # the times are rounded to t's precision, as a python float would be
+        t_u_start = (init_time + delta * u_start_idx.double()).to(t.dtype)
+        t_u_end = (init_time + delta * u_end_idx.double()).to(t.dtype)
+
+        deltas = in_window.type(torch.get_default_dtype())
+        windows = torch.arange(len(u_sz))
+        long = u_sz > 1
+        deltas[windows, 0] = torch.where(
+            long, 1. - (t_start - t_u_start) / delta,
+            (t_end - t_start) / delta).type(deltas.dtype)
+        deltas[windows[long], u_sz[long] - 1] = (
+            (t_end - t_u_end) / delta)[long].type(deltas.dtype)
+
+        rnn_input = torch.cat((u_seq, deltas[..., None]), dim=-1)
 
         return rnn_input, u_sz
 
@@ -195,5 +476,22 @@ class TrajectoryDataset(Dataset):
         return self.len
 
     def __getitem__(self, index):
+        if self.lazy:
+            k_tr, start_idx, end_idx = self.windows[index].tolist()
+            rnn_input, _ = self.process_examples(
+                [start_idx], [end_idx], self.time[k_tr],
+                self.control_seq[k_tr], self.delta,
+                self.control_holds[k_tr], int(self.seq_lens[index]))
+
+            return (self.init_state[index], self.state[index],
+                    rnn_input[0].type(torch.get_default_dtype()),
+                    self.seq_lens[index])
+
         return (self.init_state[index], self.state[index],
                 self.rnn_input[index], self.seq_lens[index])
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # pickled before the lazy mode existed
+        self.__dict__.setdefault("lazy", False)
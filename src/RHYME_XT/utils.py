@@ -174,6 +174,7 @@ def max_seq_len(value):
 
 
 def pack_model_inputs(x0, t, u, delta):
+    u = np.asarray(u)  # every control step of a compact (PiecewiseConstant) control
     t = torch.Tensor(t.reshape((-1, 1))).flip(0)
     x0 = torch.Tensor(x0.reshape((1, *x0.shape))).repeat(t.shape[0], *([1] * len(x0.shape)))
     rnn_inputs = torch.empty((t.shape[0], u.shape[0], u.shape[1] + 1))
@@ -1,11 +1,18 @@
-import numpy as np
 from . import initial_state
+from .sequence_generators import PiecewiseConstant
 from brian2 import *
+import numpy as np  # after the star import, which shadows np with brian2's slower unit-checking wrappers
 from .visualization import visualise_connectivity, heatmap_1D, plot_animate_1d, heatmap_1D_adj, heatmap_1D_adj_2,plot_slider_1d,plot_fixed_views,plot_spatio_temporal_slices
+from scipy import sparse
+from scipy import fft as scipy_fft
+import tempfile
 import time
 
 class Dynamics:
 
+    # Models with an analytic Jacobian d(_dx)/dx override this with a method jac(x, u)
+    jac = None
+
     def __init__(self, state_dim, control_dim, mask=None,input_mask=None):
         self.n = state_dim
         self.m = control_dim
@@ -15,12 +22,19 @@ class Dynamics:
         self.p = sum(self.mask)
         self.input_mask = None
         self.locations = None
+        self.jac_sparsity = None  # sparsity pattern of the Jacobian, used if jac is None
 
         self._method = "RK45"
 
     def __call__(self, x, u):
         return self._dx(x, u)
 
+    def _dx_batch(self, X, U):
+        """Right-hand side for a batch of states X (batch, n) and controls U (batch, m).
+
+        Models override this with a vectorised version, the default evaluates _dx row by row."""
+        return np.stack([np.asarray(self._dx(x, u)) for (x, u) in zip(X, U)])
+
     def default_initial_state(self) -> initial_state.InitialStateGenerator:
         """Returns an instance of the default initial state sampler."""
         return initial_state.GaussianInitialState(self.n)
@@ -51,6 +65,9 @@ class LinearSys(Dynamics):
     def _dx(self, x, u):
         return self.a @ x + self.b @ u
 
+    def _dx_batch(self, X, U):
+        return X @ self.a.T + U @ self.b.T
+
 
 class VanDerPol(Dynamics):
 
@@ -67,6 +84,14 @@ class VanDerPol(Dynamics):
 
         return (dp, dv)
 
+    def _dx_batch(self, X, U):
+        p, v = X.T
+
+        dp = v
+        dv = -p + self.damping * (1 - p**2) * v + U[:, 0]
+
+        return np.column_stack((dp, dv))
+
 
 class FitzHughNagumo(Dynamics):
 
@@ -86,6 +111,20 @@ class FitzHughNagumo(Dynamics):
 
         return (dv, dw)
 
+    def _dx_batch(self, X, U):
+        v, w = X.T
+
+        dv = 50 * (v - v**3 - w + U[:, 0])
+        dw = (v - self.a - self.b * w) / self.tau
+
+        return np.column_stack((dv, dw))
+
+    def jac(self, x, u):
+        v, w = x
+
+        return np.array([[50 * (1 - 3 * v**2), -50.],
+                         [1. / self.tau, -self.b / self.tau]])
+
 
 class Pendulum(Dynamics):
 
@@ -102,6 +141,14 @@ class Pendulum(Dynamics):
 
         return (dp, dv)
 
+    def _dx_batch(self, X, U):
+        p, v = X.T
+
+        dp = v
+        dv = -self.freq2 * np.sin(p) - self.damping * v + U[:, 0]
+
+        return np.column_stack((dp, dv))
+
 
 class HodgkinHuxleyFS(Dynamics):
 
@@ -156,6 +203,53 @@ class HodgkinHuxleyFS(Dynamics):
 
         return tuple(self.time_scale * dx for dx in (dv, dn, dm, dh))
 
+    def _dx_batch(self, X, U):
+        v, n, m, h = X.T
+
+        # denormalise first state variable
+        v = self.v_scale * v
+
+        dv = (U[:, 0] - self.g_k * n**4 *
+              (v - self.v_k) - self.g_na * m**3 * h *
+              (v - self.v_na) - self.g_l * (v - self.v_l)) / (100. * self.c_m)
+
+        a_n = -0.032 * (v - self.v_t -
+                        15.) / (np.exp(-(v - self.v_t - 15.) / 5.) - 1)
+        b_n = 0.5 * np.exp(-(v - self.v_t - 10.) / 40.)
+        dn = a_n * (1. - n) - b_n * n
+
+        a_m = -0.32 * (v - self.v_t -
+                       13.) / (np.exp(-(v - self.v_t - 13.) / 4.) - 1)
+        b_m = 0.28 * (v - self.v_t - 40.) / (np.exp(
+            (v - self.v_t - 40.) / 5.) - 1)
+        dm = a_m * (1. - m) - b_m * m
+
+        a_h = 0.128 * np.exp(-(v - self.v_t - 17.) / 18.)
+        b_h = 4. / (1. + np.exp(-(v - self.v_t - 40.) / 5.))
+        dh = a_h * (1. - h) - b_h * h
+
+        return self.time_scale * np.column_stack((dv, dn, dm, dh))
+
+    def jac(self, x, u):
+        v, n, m, h = x
+
+        # denormalise first state variable
+        v = self.v_scale * v
+        c = 100. * self.c_m
+
+        J = np.zeros((4, 4))
+        J[0, 0] = self.v_scale * (-self.g_k * n**4 - self.g_na * m**3 * h -
+                                  self.g_l) / c
+        J[0, 1] = -4. * self.g_k * n**3 * (v - self.v_k) / c
+        J[0, 2] = -3. * self.g_na * m**2 * h * (v - self.v_na) / c
+        J[0, 3] = -self.g_na * m**3 * (v - self.v_na) / c
+
+        d_gate, d_v = _hh_gates_jac(v, self.v_t, n, m, h)
+        J[(1, 2, 3), (1, 2, 3)] = d_gate
+        J[1:, 0] = self.v_scale * d_v
+
+        return self.time_scale * J
+
 
 class HodgkinHuxleyRSA(Dynamics):
 
@@ -217,6 +311,62 @@ class HodgkinHuxleyRSA(Dynamics):
 
         return tuple(self.time_scale * dx for dx in (dv, dp, dn, dm, dh))
 
+    def _dx_batch(self, X, U):
+        v, p, n, m, h = X.T
+
+        # denormalise first state variable
+        v = self.v_scale * v
+
+        dv = (U[:, 0] - (self.g_k * n**4 + self.g_m * p) *
+              (v - self.v_k) - self.g_na * m**3 * h *
+              (v - self.v_na) - self.g_l * (v - self.v_l)) / (100. * self.c_m)
+
+        t_p = self.t_max / (3.3 * np.exp(
+            (v + 35.) / 20.) + np.exp(-(v + 35.) / 20.))
+
+        dp = (1. / (1 + np.exp(-(v + 35) / 10.)) - p) / t_p
+
+        a_n = -0.032 * (v - self.v_t -
+                        15.) / (np.exp(-(v - self.v_t - 15.) / 5.) - 1)
+        b_n = 0.5 * np.exp(-(v - self.v_t - 10.) / 40.)
+        dn = a_n * (1. - n) - b_n * n
+
+        a_m = -0.32 * (v - self.v_t -
+                       13.) / (np.exp(-(v - self.v_t - 13.) / 4.) - 1)
+        b_m = 0.28 * (v - self.v_t - 40.) / (np.exp(
+            (v - self.v_t - 40.) / 5.) - 1)
+        dm = a_m * (1. - m) - b_m * m
+
+        a_h = 0.128 * np.exp(-(v - self.v_t - 17.) / 18.)
+        b_h = 4. / (1. + np.exp(-(v - self.v_t - 40.) / 5.))
+        dh = a_h * (1. - h) - b_h * h
+
+        return self.time_scale * np.column_stack((dv, dp, dn, dm, dh))
+
+    def jac(self, x, u):
+        v, p, n, m, h = x
+
+        # denormalise first state variable
+        v = self.v_scale * v
+        c = 100. * self.c_m
+
+        J = np.zeros((5, 5))
+        J[0, 0] = self.v_scale * (-(self.g_k * n**4 + self.g_m * p) -
+                                  self.g_na * m**3 * h - self.g_l) / c
+        J[0, 1] = -self.g_m * (v - self.v_k) / c
+        J[0, 2] = -4. * self.g_k * n**3 * (v - self.v_k) / c
+        J[0, 3] = -3. * self.g_na * m**2 * h * (v - self.v_na) / c
+        J[0, 4] = -self.g_na * m**3 * (v - self.v_na) / c
+
+        J[1, 1], d_v = _hh_p_jac(v, p, self.t_max)
+        J[1, 0] = self.v_scale * d_v
+
+        d_gate, d_v = _hh_gates_jac(v, self.v_t, n, m, h)
+        J[(2, 3, 4), (2, 3, 4)] = d_gate
+        J[2:, 0] = self.v_scale * d_v
+
+        return self.time_scale * J
+
 
 class HodgkinHuxleyIB(Dynamics):
 
@@ -290,6 +440,87 @@ class HodgkinHuxleyIB(Dynamics):
         return tuple(self.time_scale * dx
                      for dx in (dv, dp, dq, ds, dn, dm, dh))
 
+    def _dx_batch(self, X, U):
+        v, p, q, s, n, m, h = X.T
+
+        # denormalise first state variable
+        v = self.v_scale * v
+
+        dv = (U[:, 0] - (self.g_k * n**4 + self.g_m * p) *
+              (v - self.v_k) - self.g_ca * q**2 * s *
+              (v - self.v_ca) - self.g_na * m**3 * h *
+              (v - self.v_na) - self.g_l * (v - self.v_l)) / (100. * self.c_m)
+
+        t_p = self.t_max / (3.3 * np.exp(
+            (v + 35.) / 20.) + np.exp(-(v + 35.) / 20.))
+
+        dp = (1. / (1 + np.exp(-(v + 35) / 10.)) - p) / t_p
+
+        a_q = 0.055 * (-27. - v) / (np.exp((-27. - v) / 3.8) - 1.)
+        b_q = 0.94 * np.exp((-75. - v) / 17.)
+        dq = a_q * (1. - q) - b_q * q
+
+        a_s = 0.000457 * np.exp((-13. - v) / 50.)
+        b_s = 0.0065 / (np.exp((-15. - v) / 28.) + 1.)
+        ds = a_s * (1. - s) - b_s * s
+
+        a_n = -0.032 * (v - self.v_t -
+                        15.) / (np.exp(-(v - self.v_t - 15.) / 5.) - 1)
+        b_n = 0.5 * np.exp(-(v - self.v_t - 10.) / 40.)
+        dn = a_n * (1. - n) - b_n * n
+
+        a_m = -0.32 * (v - self.v_t -
+                       13.) / (np.exp(-(v - self.v_t - 13.) / 4.) - 1)
+        b_m = 0.28 * (v - self.v_t - 40.) / (np.exp(
+            (v - self.v_t - 40.) / 5.) - 1)
+        dm = a_m * (1. - m) - b_m * m
+
+        a_h = 0.128 * np.exp(-(v - self.v_t - 17.) / 18.)
+        b_h = 4. / (1. + np.exp(-(v - self.v_t - 40.) / 5.))
+        dh = a_h * (1. - h) - b_h * h
+
+        return self.time_scale * np.column_stack((dv, dp, dq, ds, dn, dm, dh))
+
+    def jac(self, x, u):
+        v, p, q, s, n, m, h = x
+
+        # denormalise first state variable
+        v = self.v_scale * v
+        c = 100. * self.c_m
+
+        J = np.zeros((7, 7))
+        J[0, 0] = self.v_scale * (-(self.g_k * n**4 + self.g_m * p) -
+                                  self.g_ca * q**2 * s -
+                                  self.g_na * m**3 * h - self.g_l) / c
+        J[0, 1] = -self.g_m * (v - self.v_k) / c
+        J[0, 2] = -2. * self.g_ca * q * s * (v - self.v_ca) / c
+        J[0, 3] = -self.g_ca * q**2 * (v - self.v_ca) / c
+        J[0, 4] = -4. * self.g_k * n**3 * (v - self.v_k) / c
+        J[0, 5] = -3. * self.g_na * m**2 * h * (v - self.v_na) / c
+        J[0, 6] = -self.g_na * m**3 * (v - self.v_na) / c
+
+        J[1, 1], d_v = _hh_p_jac(v, p, self.t_max)
+        J[1, 0] = self.v_scale * d_v
+
+        # a_q is a function of z = -27 - v
+        a_q, da_q = _rate_expm1(0.055, -27. - v, -3.8)
+        b_q = 0.94 * np.exp((-75. - v) / 17.)
+        J[2, 2] = -(a_q + b_q)
+        J[2, 0] = self.v_scale * (-da_q * (1. - q) + b_q / 17. * q)
+
+        a_s = 0.000457 * np.exp((-13. - v) / 50.)
+        e_s = np.exp((-15. - v) / 28.)
+        b_s = 0.0065 / (e_s + 1.)
+        J[3, 3] = -(a_s + b_s)
+        J[3, 0] = self.v_scale * (-a_s / 50. * (1. - s) -
+                                  0.0065 * e_s / (28. * (e_s + 1.)**2) * s)
+
+        d_gate, d_v = _hh_gates_jac(v, self.v_t, n, m, h)
+        J[(4, 5, 6), (4, 5, 6)] = d_gate
+        J[4:, 0] = self.v_scale * d_v
+
+        return self.time_scale * J
+
 
 class HodgkinHuxleyFFE(Dynamics):
     """
@@ -318,6 +549,32 @@ class HodgkinHuxleyFFE(Dynamics):
 
         return (*dx_in, *dx_out)
 
+    def _dx_batch(self, X, U):
+        X_in = X[:, :5]
+        X_out = X[:, 5:]
+        delta = self.v_scale * (X_in[:, :1] - X_out[:, :1])
+
+        dX_in = self.rsa._dx_batch(X_in, U)
+        dX_out = self.rsa._dx_batch(X_out, self.eps * delta)
+
+        return np.hstack((dX_in, dX_out))
+
+    def jac(self, x, u):
+        x_in = x[:5]
+        x_out = x[5:]
+        delta = self.v_scale * (x_in[0] - x_out[0])
+
+        J = np.zeros((10, 10))
+        J[:5, :5] = self.rsa.jac(x_in, u)
+        J[5:, 5:] = self.rsa.jac(x_out, self.eps * delta)
+
+        # the input current of the second neuron depends on both voltages
+        du = self.time_scale * self.eps * self.v_scale / (100. * self.rsa.c_m)
+        J[5, 0] += du
+        J[5, 5] -= du
+
+        return J
+
 
 class HodgkinHuxleyFBE(Dynamics):
     """
@@ -363,6 +620,55 @@ class HodgkinHuxleyFBE(Dynamics):
 
         return (*dx_in, *dx_out, self.time_scale * dr)
 
+    def _dx_batch(self, X, U):
+        X_in = X[:, :5]
+        X_out = X[:, 5:-1]
+        r = X[:, -1:]
+
+        v_in = self.v_scale * X_in[:, :1]
+        v_out = self.v_scale * X_out[:, :1]
+
+        delta_el = v_in - v_out
+        delta_ch = self.v_syn - v_out
+
+        dX_in = self.rsa._dx_batch(X_in, U + r * self.eps_ch * delta_ch)
+        dX_out = self.rsa._dx_batch(X_out, self.eps_el * delta_el)
+
+        dr = (1 / self.tau_r - 1 / self.tau_d) * (1. - r) / (
+            1. + np.exp(-v_out + self.v0)) - r / self.tau_d
+
+        return np.hstack((dX_in, dX_out, self.time_scale * dr))
+
+    def jac(self, x, u):
+        x_in = x[:5]
+        x_out = x[5:-1]
+        r = x[-1]
+
+        v_in = self.v_scale * x_in[0]
+        v_out = self.v_scale * x_out[0]
+
+        delta_el = v_in - v_out
+        delta_ch = self.v_syn - v_out
+
+        J = np.zeros((11, 11))
+        J[:5, :5] = self.rsa.jac(x_in, u + r * self.eps_ch * delta_ch)
+        J[5:10, 5:10] = self.rsa.jac(x_out, self.eps_el * delta_el)
+
+        # derivative of dv w.r.t. the input current of a neuron
+        du = self.time_scale / (100. * self.rsa.c_m)
+        J[0, 5] += du * r * self.eps_ch * -self.v_scale
+        J[0, 10] += du * self.eps_ch * delta_ch
+        J[5, 0] += du * self.eps_el * self.v_scale
+        J[5, 5] -= du * self.eps_el * self.v_scale
+
+        e = np.exp(-v_out + self.v0)
+        J[10, 5] = self.time_scale * self.v_scale * (
+            1 / self.tau_r - 1 / self.tau_d) * (1. - r) * e / (1. + e)**2
+        J[10, 10] = self.time_scale * (-(1 / self.tau_r - 1 / self.tau_d) /
+                                       (1. + e) - 1 / self.tau_d)
+
+        return J
+
 
 class GreenshieldsTraffic(Dynamics):
 
@@ -371,6 +677,10 @@ class GreenshieldsTraffic(Dynamics):
         self.inv_step = self.n if not dx else 1. / dx
         self.v0 = v0
 
+        # every cell only depends on itself and the upstream cell
+        self.jac_sparsity = sparse.diags([np.ones(n - 1), np.ones(n)], [-1, 0],
+                                         format='csc')
+
     def flux(self, x):
         return self.v0 * x * (1. - x)
 
@@ -385,6 +695,20 @@ class GreenshieldsTraffic(Dynamics):
 
         return dx
 
+    def _dx_batch(self, X, U):
+        q_out = self.flux(X)
+
+        q_in = np.roll(q_out, 1, axis=1)
+        q_in[:, 0] = self.flux(U[:, 0])
+
+        return self.inv_step * (q_in - q_out)
+
+    def jac(self, x, u):
+        dq = self.v0 * (1. - 2. * x)  # derivative of the flux
+
+        return self.inv_step * sparse.diags([dq[:-1], -dq], [-1, 0],
+                                            format='csc')
+
 
 class TwoTank(Dynamics):
     ''' Two tank dynamics with overflow.
@@ -419,6 +743,45 @@ class TwoTank(Dynamics):
 
         return (dh1, dh2)
 
+    def _dx_batch(self, X, U):
+        h1, h2 = X.T
+
+        pump = U[:, 0]
+        valve = U[:, 1]
+
+        dh1 = self.c1 * (1.0 - valve) * pump - self.c2 * np.sqrt(np.abs(h1))
+        dh2 = self.c1 * valve * pump + self.c2 * \
+            np.sqrt(np.abs(h1)) - self.c2 * np.sqrt(np.abs(h2))
+
+        dh1[((h1 >= 1.) & (dh1 > 0.)) | ((h1 <= 1e-10) & (dh1 < 0.))] = 0.
+        dh2[((h2 >= 1.) & (dh2 > 0.)) | ((h2 <= 1e-10) & (dh2 < 0.))] = 0.
+
+        return np.column_stack((dh1, dh2))
+
+    def jac(self, x, u):
+        h1, h2 = x
+
+        pump = u[0]
+        valve = u[1]
+
+        dh1 = self.c1 * (1.0 - valve) * pump - self.c2 * np.sqrt(np.abs(h1))
+        dh2 = self.c1 * valve * pump + self.c2 * \
+            np.sqrt(np.abs(h1)) - self.c2 * np.sqrt(np.abs(h2))
+
+        # derivatives of c2 * sqrt(|h|), bounded at the empty tank
+        s1 = self.c2 * np.sign(h1) / (2. * np.sqrt(max(abs(h1), 1e-10)))
+        s2 = self.c2 * np.sign(h2) / (2. * np.sqrt(max(abs(h2), 1e-10)))
+
+        J = np.array([[-s1, 0.], [s1, -s2]])
+
+        if (h1 >= 1. and dh1 > 0.) or (h1 <= 1e-10 and dh1 < 0.):
+            J[0] = 0.
+
+        if (h2 >= 1. and dh2 > 0.) or (h2 <= 1e-10 and dh2 < 0.):
+            J[1] = 0.
+
+        return J
+
 class Heat(Dynamics):
     def __init__(self,n,alpha,L,dx=None):
         ''' 1 Dimensional heat equation with spatial temporal inputs
@@ -432,6 +795,17 @@ class Heat(Dynamics):
         self.locations_orig = np.linspace(0, 100, 50)
         self.sigma = 100/15
 
+        # periodic second difference, the Jacobian does not depend on x or u. Built from index
+        # arrays, whose duplicates are summed: for n = 2 both neighbours are the same cell, like in
+        # the np.roll of _dx, and diags would get the same offset twice
+        i = np.arange(n)
+        rows = np.repeat(i, 3)
+        cols = np.stack([(i - 1) % n, i, (i + 1) % n], axis=1).reshape(-1)
+        values = np.tile([1., -2., 1.], n)
+        self._laplacian = self.alpha * (self.inv_x_step**2) * sparse.coo_matrix(
+            (values, (rows, cols)), shape=(n, n)).tocsc()
+        self.jac_sparsity = self._laplacian != 0
+
     def set_input_mask(self):
         self.first_input = np.random.uniform(0.1*self.L, 0.9*self.L)                        # location of first input
         self.second_input = np.random.uniform(0.1*self.L, 0.9*self.L)                       # location of second input
@@ -451,40 +825,93 @@ class Heat(Dynamics):
         # dt[-1] = self.alpha * (self.inv_x_step**2) * 2*(x[-2]-x[-1])
 
         return dt
+
+    def _dx_batch(self, X, U):
+        return self.alpha * (self.inv_x_step**2) * (
+            np.roll(X, -1, axis=1) - 2 * X + np.roll(X, 1, axis=1)) + U @ self.input_mask.T
+
+    def jac(self, x, u):
+        return self._laplacian
     
-class Amari(Dynamics):
-    def __init__(self,x_lim,dx,theta,kernel_type,kernel_pars):
-        '''Amari, S. I. (1977). Dynamics of pattern formation in lateral-inhibition type neural fields. Biological Cybernetics, 27(2), 77-87,'
-        'implementation based on: https://github.com/w-wojtak/neural-fields-python?tab=readme-ov-file#1'''
+def _etd_coefficients(L, h):
+    '''exp(hL), h phi1(hL) and h phi2(hL) of exponential time differencing steps, with
+    phi1(z) = (e^z - 1)/z and phi2(z) = (e^z - 1 - z)/z^2 (series expansions for small z).'''
+    z = np.asarray(h * L, dtype=float)
+    small = np.abs(z) < 1e-3
+    z_safe = np.where(small, 1., z)
+    phi1 = np.where(small, 1 + z/2 + z**2/6 + z**3/24, np.expm1(z_safe) / z_safe)
+    phi2 = np.where(small, 1/2 + z/6 + z**2/24 + z**3/120, (np.expm1(z_safe) - z_safe) / z_safe**2)
+    return np.exp(z), h * phi1, h * phi2
+
+
+class _FieldRecorder:
+    '''Records the n_fields fields of a batch simulation on the time grid t: every step if full_state,
+    and the steps nearest to the sample times t_samples (B, n_s) if these are given.'''
+
+    def __init__(self, t, t_samples, batch_size, n_x, n_fields, full_state):
+        self.history = np.zeros([batch_size, len(t), n_x, n_fields]) if full_state else None
+        self.samples = None
+        self.t_samples = None
+
+        if t_samples is not None:
+            dt = t[1] - t[0] if len(t) > 1 else 1.
+            steps = np.clip(np.rint((t_samples - t[0]) / dt).astype(int), 0, len(t) - 1)
+            self.samples = np.zeros([batch_size, steps.shape[1], n_x, n_fields])
+            self.t_samples = t[steps]
+
+            # the (trajectory, sample) pairs recorded at step i are self._b[lo:hi], self._j[lo:hi]
+            # with lo, hi = self._bounds[i:i+2]
+            order = np.argsort(steps, axis=None, kind='stable')
+            self._b, self._j = np.unravel_index(order, steps.shape)
+            self._bounds = np.searchsorted(steps.ravel()[order], np.arange(len(t) + 1))
+
+    def record(self, i, *fields):
+        for (k, field) in enumerate(fields):
+            if self.history is not None:
+                self.history[:, i, :, k] = field
+
+            if self.samples is not None:
+                lo, hi = self._bounds[i], self._bounds[i + 1]
+                if lo < hi:
+                    b = self._b[lo:hi]
+                    self.samples[b, self._j[lo:hi], :, k] = field[b]
+
+    def result(self, t):
+        '''Returns (history, t, samples, t_samples), the last axis is dropped for a single field.'''
+        history, samples = self.history, self.samples
+        if history is not None and history.shape[-1] == 1:
+            history = history[..., 0]
+        if samples is not None and samples.shape[-1] == 1:
+            samples = samples[..., 0]
+
+        return history, t, samples, self.t_samples
+
+
+class NeuralField(Dynamics):
+    '''Base class of the Amari models, which are simulated with a spectral method.
+
+    The kernel convolutions use real FFTs along the last (spatial) axis. The kernel spectra are
+    computed once, scaled by dx and with the ifftshift of the convolution folded in as a phase,
+    and the simulations write into buffers that are allocated once per call.'''
+
+    _n_fields = 1 # number of fields in the state, stacked along its last axis
+
+    # euler: explicit Euler. etd1, etd2: exponential time differencing of first order and
+    # second order (Cox-Matthews ETD2RK), which integrate the linear decay (and diffusion) exactly
+    _INTEGRATORS = ("euler", "etd1", "etd2")
+
+    def __init__(self, state_dim, control_dim, x, dx, fft_workers=1, integrator="euler"):
+        super().__init__(state_dim, control_dim)
+        if integrator not in self._INTEGRATORS:
+            raise ValueError(f"Unknown integrator {integrator}, choose from {self._INTEGRATORS}.")
 
-        super().__init__((int(np.round(x_lim/dx))*2+1,), int(np.round(x_lim/dx))*2+1)
         self._method = "SM" # Spectral method, uses FFT-based convolutions
-
-        self.x_lim = x_lim
+        self.integrator = integrator
+        self.x = x
         self.dx = dx
-        self.theta = theta
-        self.x = np.arange(-x_lim,x_lim+dx,dx)
         self.locations = self.x
-        import matplotlib.pyplot as plt
-        if kernel_type == 0:
-            self.w_hat = np.fft.fft(self.kernel_gauss(self.x, *kernel_pars))
-            plt.plot(self.x,self.kernel_gauss(self.x, *kernel_pars))
-            print("Kernel integral:", np.sum(self.kernel_gauss(self.x, *kernel_pars) * dx))
-        elif kernel_type == 1:
-            self.w_hat = np.fft.fft(self.kernel_mex(self.x, *kernel_pars))
-            plt.plot(self.x,self.kernel_mex(self.x, *kernel_pars))
-            print("Kernel integral:", np.sum(self.kernel_mex(self.x, *kernel_pars) * dx))
-        elif kernel_type == 2:
-            self.w_hat = np.fft.fft(self.kernel_osc(self.x, *kernel_pars))
-            plt.plot(self.x,self.kernel_osc(self.x, *kernel_pars))
-            print("Kernel integral:", np.sum(self.kernel_osc(self.x, *kernel_pars) * dx))
-        elif kernel_type == 3:
-            self.w_hat = np.fft.fft(self.kernel_cos(self.x, *kernel_pars))
-            plt.plot(self.x,self.kernel_cos(self.x, *kernel_pars))
-            print("Kernel integral:", np.sum(self.kernel_cos(self.x, *kernel_pars) * dx))
-
-        plt.show()
-
+        self.fft_workers = fft_workers # threads per FFT, the rows of a batch are transformed in parallel
+        self._fold_idx = -np.arange(len(x) // 2 + 1) % len(x) # index of -k
 
     def kernel_mex(self,x, a_ex, s_ex, a_in, s_in, w_in):
         return a_ex * np.exp(-0.5 * x ** 2 / s_ex ** 2) - a_in * np.exp(-0.5 * x ** 2 / s_in ** 2) - w_in
@@ -498,39 +925,189 @@ class Amari(Dynamics):
     def kernel_cos(self, x,A_1,A_2,a_1,a_2):
         return (A_1*np.exp(-a_1* x ** 2 ) - A_2*np.exp(-a_2 * x ** 2)) * np.cos(x/2)
 
-    def sigmoid(self,x):
-            return 1 / (1 + np.exp(-100* (x - self.theta)))
-
-    def simulate(self,u0,inputs,n_samples,time_horizon,init_time):
+    def kernel(self, kernel_type, kernel_pars):
+        # 0: Gaussian, 1: Mex-hat, 2: Oscillatory, 3: Cosine
+        kernels = [self.kernel_gauss, self.kernel_mex, self.kernel_osc, self.kernel_cos]
+        return kernels[kernel_type](self.x, *kernel_pars)
+
+    def kernel_spectrum(self, w):
+        '''dx * rfft(w), times the phase that shifts the convolution result like ifftshift.'''
+        n = len(self.x)
+        k = np.arange(n // 2 + 1)
+        return self.dx * scipy_fft.rfft(w) * np.exp(2j * np.pi * k * (n // 2) / n)
+
+    def _sigmoid(self, x, beta, theta, out):
+        # 1 / (1 + exp(-beta * (x - theta))), in place
+        np.subtract(x, theta, out=out)
+        np.multiply(out, -beta, out=out)
+        np.exp(out, out=out)
+        np.add(out, 1., out=out)
+        return np.reciprocal(out, out=out)
+
+    def _rfft(self, f):
+        return scipy_fft.rfft(f, axis=-1, workers=self.fft_workers)
+
+    def _fold(self, f, out):
+        '''The first n//2 + 1 entries of (f[k] + f[-k]) / 2. Multiplied with a kernel spectrum, this
+        gives the same real part after the inverse transform as f itself (for the coupled models,
+        which multiply the firing rates directly with the kernel spectra).'''
+        np.add(f[..., :out.shape[-1]], f[..., self._fold_idx], out=out)
+        return np.multiply(out, 0.5, out=out)
+
+    def _convolve(self, f_hat, w_hat, out, work):
+        '''Writes the real field with spectrum f_hat * w_hat into out.'''
+        np.multiply(f_hat, w_hat, out=work)
+        out[...] = scipy_fft.irfft(work, len(self.x), axis=-1, workers=self.fft_workers)
+        return out
+
+    def _conv(self, f_hat, w_hat):
+        # allocating version of _convolve
+        return scipy_fft.irfft(f_hat * w_hat, len(self.x), axis=-1, workers=self.fft_workers)
+
+    def _workspace(self, batch_size, n_fields, n_folded=0):
+        '''Buffers for one simulation: n_fields of shape (B, n_x), n_folded of shape (B, n_x//2 + 1)
+        and a complex one of that shape for the products of spectra.'''
+        n = len(self.x)
+        return ([np.empty((batch_size, n)) for _ in range(n_fields)] +
+                [np.empty((batch_size, n // 2 + 1)) for _ in range(n_folded)] +
+                [np.empty((batch_size, n // 2 + 1), dtype=complex)])
 
-        dt = (time_horizon-init_time)/inputs.shape[0]
+    def simulate(self,x0,inputs,n_samples,time_horizon,init_time):
+        history, t, _, _ = self.simulate_batch(x0[None], inputs[None], n_samples, time_horizon, init_time)
+        return history[0], t
+
+    def simulate_batch(self,x0,inputs,n_samples,time_horizon,init_time,t_samples=None,full_state=True):
+        '''Simulates B initial states x0 with inputs (B, n_steps, n_x) together, with one explicit Euler
+        step per input. Returns (history, t, samples, t_samples): the states at every step (None unless
+        full_state) at the times t, and the states at the steps nearest to the sample times t_samples
+        (B, n_s) (None if not given) together with the times of those steps.'''
+        inputs = np.asarray(inputs, dtype=float)
+        dt = (time_horizon-init_time)/inputs.shape[1]
         t = np.arange(init_time,time_horizon,dt)
-        history_u = np.zeros([len(t), len(self.x)])
-        u_field = u0
-        for i in range(0, len(t)):
-            # f_hat = np.fft.fft(np.heaviside(u_field - self.theta, 1))
-            f_hat = np.fft.fft(self.sigmoid(u_field))
-            conv = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat * self.w_hat)))
-            # print(f_hat)  
-            # print('i:', i   )
-            # print(conv)
-            u_field = u_field + (dt/0.5) * (-u_field + conv + inputs[i, :])
-            history_u[i, :] = u_field
-        
-        return history_u, t
+        recorder = _FieldRecorder(t, t_samples, x0.shape[0], len(self.x), self._n_fields, full_state)
+
+        if self.integrator == "euler":
+            self._euler(x0, inputs, dt, len(t), recorder)
+        else:
+            self._etd(x0, inputs, dt, len(t), recorder)
+
+        return recorder.result(t)
+
+    def _etd(self, x0, inputs, dt, n_steps, recorder):
+        '''Exponential time differencing. The linear part of every field (_linear_part: a scalar, or
+        the rfft symbol of an operator that is diagonal in Fourier space) is integrated exactly and
+        the rest (_nonlinear), including the inputs, which are constant over a step, with an
+        explicit first (etd1) or second order (etd2) scheme.'''
+        n = len(self.x)
+        x0 = np.reshape(x0, (x0.shape[0], n, self._n_fields))
+        fields = [x0[..., k].copy() for k in range(self._n_fields)]
+        coefs = [_etd_coefficients(L, dt) for L in self._linear_part()]
+
+        def irfft(x_hat):
+            return scipy_fft.irfft(x_hat, n, axis=-1, workers=self.fft_workers)
+
+        def propagate(k, u, N):
+            # exp(hL) u + h phi1(hL) N
+            E, phi1, _ = coefs[k]
+            if np.ndim(E) == 0:
+                return E * u + phi1 * N
+            return irfft(E * self._rfft(u) + phi1 * self._rfft(N))
+
+        def correct(k, a, dN):
+            # a + h phi2(hL) dN
+            _, _, phi2 = coefs[k]
+            if np.ndim(phi2) == 0:
+                return a + phi2 * dN
+            return a + irfft(phi2 * self._rfft(dN))
+
+        for i in range(0, n_steps):
+            N = self._nonlinear(fields, inputs[:, i, :], i)
+            a = [propagate(k, u, N_k) for (k, (u, N_k)) in enumerate(zip(fields, N))]
+
+            if self.integrator == "etd2":
+                N_a = self._nonlinear(a, inputs[:, i, :], i)
+                a = [correct(k, a_k, N_a_k - N_k) for (k, (a_k, N_k, N_a_k)) in enumerate(zip(a, N, N_a))]
+
+            fields = a
+            recorder.record(i, *fields)
+
+    def integrator_error(self, x0, inputs, time_horizon, init_time, refinement=1):
+        '''Compares the trajectories of B initial states x0 and inputs (B, n_steps, n_x) computed
+        with self.integrator to explicit Euler, the latter with refinement steps per input.
+        Returns the maximum absolute and the relative L2 error over all steps.
+
+        For AmariCoupledFHN, whose kernels are halved every step, only refinement=1 compares the
+        same model.'''
+        history, _, _, _ = self.simulate_batch(x0, inputs, None, time_horizon, init_time)
+
+        integrator = self.integrator
+        self.integrator = "euler"
+        try:
+            reference, _, _, _ = self.simulate_batch(x0, np.repeat(inputs, refinement, axis=1), None,
+                                                     time_horizon, init_time)
+        finally:
+            self.integrator = integrator
+        reference = reference[:, refinement - 1::refinement]
+
+        return {
+            "max_abs_error": float(np.max(np.abs(history - reference))),
+            "relative_l2_error": float(np.linalg.norm(history - reference) / np.linalg.norm(reference)),
+        }
+
+
+class Amari(NeuralField):
+    def __init__(self,x_lim,dx,theta,kernel_type,kernel_pars,fft_workers=1,integrator="euler"):
+        '''Amari, S. I. (1977). Dynamics of pattern formation in lateral-inhibition type neural fields. Biological Cybernetics, 27(2), 77-87,'
+        'implementation based on: https://github.com/w-wojtak/neural-fields-python?tab=readme-ov-file#1'''
 
-class AmariCoupled(Dynamics):
-    def __init__(self,x_lim,dx,theta,beta,tau_u,tau_v,kernel_types,kernel_pars,diffusion,diffusion_coeff,advection,advection_coeff):
+        super().__init__((int(np.round(x_lim/dx))*2+1,), int(np.round(x_lim/dx))*2+1,
+                         np.arange(-x_lim,x_lim+dx,dx), dx, fft_workers, integrator)
+
+        self.x_lim = x_lim
+        self.theta = theta
+        import matplotlib.pyplot as plt
+        w = self.kernel(kernel_type, kernel_pars)
+        self.w_hat = self.kernel_spectrum(w)
+        plt.plot(self.x,w)
+        print("Kernel integral:", np.sum(w * dx))
+
+        plt.show()
+
+    def sigmoid(self,x):
+            return 1 / (1 + np.exp(-100* (x - self.theta)))
+
+    def _euler(self, u0, inputs, dt, n_steps, recorder):
+        u_field, rate, conv, work = self._workspace(u0.shape[0], 3)
+        u_field[...] = u0
+
+        for i in range(0, n_steps):
+            # u += dt/0.5 * (-u + w * f(u) + input)
+            f_hat = self._rfft(self._sigmoid(u_field, 100., self.theta, rate))
+            self._convolve(f_hat, self.w_hat, conv, work)
+            np.subtract(conv, u_field, out=conv)
+            np.add(conv, inputs[:, i, :], out=conv)
+            np.multiply(conv, dt/0.5, out=conv)
+            u_field += conv
+            recorder.record(i, u_field)
+
+    def _linear_part(self):
+        return [-1/0.5]
+
+    def _nonlinear(self, fields, inputs, i):
+        u_field, = fields
+        conv = self._conv(self._rfft(self.sigmoid(u_field)), self.w_hat)
+        return [(conv + inputs) / 0.5]
+
+class AmariCoupled(NeuralField):
+    _n_fields = 2 # u and v
+    def __init__(self,x_lim,dx,theta,beta,tau_u,tau_v,kernel_types,kernel_pars,diffusion,diffusion_coeff,advection,advection_coeff,fft_workers=1,integrator="euler"):
         '''Two field Amari, S. I. (1977). Dynamics of pattern formation in lateral-inhibition type neural fields. Biological Cybernetics, 27(2), 77-87,'
         'implementation based on: https://github.com/w-wojtak/neural-fields-python?tab=readme-ov-file#1'''
 
-        super().__init__((int(np.round(x_lim/dx))+1,2), int(np.round(x_lim/dx)) +1)
-        self._method = "SM" # Spectral method, uses FFT-based convolutions
+        super().__init__((int(np.round(x_lim/dx))+1,2), int(np.round(x_lim/dx)) +1,
+                         np.arange(0,x_lim+dx,dx), dx, fft_workers, integrator)
         self.x_lim = x_lim
-        self.dx = dx
         self.theta = theta
-        self.x = np.arange(0,x_lim+dx,dx)
-        self.locations = self.x
         self.beta = beta
         self.tau_u = tau_u 
         self.tau_v = tau_v
@@ -538,186 +1115,185 @@ class AmariCoupled(Dynamics):
         self.diffusion_coeff = diffusion_coeff
         self.advection = bool(advection)
         self.advection_coeff = advection_coeff
-        self.w_hat = []
 
         # kernels for u and v
-        for (kernel_type,kernel_par) in zip(kernel_types,kernel_pars):
-            if kernel_type == 0:
-                self.w_hat.append(np.fft.fft(self.kernel_gauss(self.x, *kernel_par)))
-            elif kernel_type == 1:
-                self.w_hat.append(np.fft.fft(self.kernel_mex(self.x, *kernel_par)))
-            elif kernel_type == 2:
-                self.w_hat.append(np.fft.fft(self.kernel_osc(self.x, *kernel_par)))
-            elif kernel_type == 3:
-                self.w_hat.append(np.fft.fft(self.kernel_cos(self.x, *kernel_par)))
-
-    def kernel_mex(self,x, a_ex, s_ex, a_in, s_in, w_in):
-        return a_ex * np.exp(-0.5 * x ** 2 / s_ex ** 2) - a_in * np.exp(-0.5 * x ** 2 / s_in ** 2) - w_in
-
-    def kernel_gauss(self,x, a_ex, s_ex, w_in):
-        return a_ex * np.exp(-0.5 * x ** 2 / s_ex ** 2) - w_in
-
-    def kernel_osc(self,x, a, b, alpha):
-        return a * (np.exp(-b*abs(x)) * ((b * np.sin(abs(alpha*x)))+np.cos(alpha*x)))
-    
-    def kernel_cos(self, x,A_1,A_2,a_1,a_2):
-        return (A_1*np.exp(-a_1* x ** 2 ) - A_2*np.exp(-a_2 * x ** 2)) * np.cos(x/2)
+        self.w_hat = [self.kernel_spectrum(self.kernel(kernel_type, kernel_par))
+                      for (kernel_type,kernel_par) in zip(kernel_types,kernel_pars)]
 
     def sigmoid(self,x, beta,theta):
         return 1 / (1 + np.exp(-beta * (x - theta)))
 
-    def simulate(self,x0,inputs,n_samples,time_horizon,init_time):
-
-        dt = (time_horizon-init_time)/inputs.shape[0]
-        t = np.arange(init_time,time_horizon,dt)
-        history_u = np.zeros([len(t), len(self.x)])
-        history_v = np.zeros([len(t), len(self.x)])
-
-        # IC
-        u_field = x0[:,0]
-        v_field = x0[:,1]
-
-        
-        k = np.fft.fftfreq(len(self.x), self.dx) * 2 * np.pi  # Wave numbers in Fourier space
-
-        u_field_full = []
-        v_field_full = []
-
-        def finite_diff_advection(v, dx):
-            # Apply zero boundary conditions for advection
-            v_copy = np.copy(v)
-            # v_copy[0] = 0   # Left boundary = 0
-            # v_copy[-1] = 0  # Right boundary = 0
-            # v_copy[0] = 0.15 * v_copy[1] + 0.7 * v_copy[2] + 0.15 * v_copy[3]
-            # v_copy[-1] = 0.15 * v_copy[-2] + 0.7 * v_copy[-3] + 0.15 * v_copy[-4]
-            return (np.roll(v_copy, -1) - np.roll(v_copy, 1)) / (2 * dx)
-
-        def finite_diff_diffusion(v, dx):
-            # Apply zero boundary conditions for diffusion
-            v_copy = np.copy(v)
-            # v_copy[0] = 0   # Left boundary = 0
-            # v_copy[-1] = 0  # Right boundary = 0a
-            return (np.roll(v_copy, -1) - 2*v_copy + np.roll(v_copy, 1)) / (dx**2)
-
-
-        for i in range(0, len(t)):
-            f_hat_u = self.sigmoid(u_field, self.beta, self.theta)
-            f_hat_v = self.sigmoid(v_field, self.beta, self.theta)
-            conv_u = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat_u * self.w_hat[0])))
-            conv_v = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat_u * self.w_hat[1])))
-
-            # Compute the second derivative of v using the Fourier domain representation
-            v_hat = np.fft.fft(v_field)  # Fourier transform of v_field
-            u_hat = np.fft.fft(u_field)  # Fourier transform of v_field
-            if self.advection:
-                # advection_term = np.real(np.fft.ifft(1j *k* v_hat))  # Multiply by k^2 for the second derivative in Fourier space
-                advection_term = finite_diff_advection(v_field, self.dx)
-            else:
-                advection_term = 0
-
+    def _euler(self, x0, inputs, dt, n_steps, recorder):
+        u_field, v_field, rate, conv_u, conv_v, diff, du, fold, work = self._workspace(x0.shape[0], 7, 1)
+        u_field[...] = x0[..., 0]
+        v_field[...] = x0[..., 1]
+
+        for i in range(0, n_steps):
+            f_hat_u = self._fold(self._sigmoid(u_field, self.beta, self.theta, rate), fold)
+            self._convolve(f_hat_u, self.w_hat[0], conv_u, work)
+            self._convolve(f_hat_u, self.w_hat[1], conv_v, work)
+
+            # u += dt/tau_u * (-u + conv_u + v + input)
+            np.subtract(conv_u, u_field, out=du)
+            du += v_field
+            du += inputs[:, i, :]
+            du *= dt / self.tau_u
+            u_field += du
+
+            # v += dt/tau_v * (-v - conv_v + u + D * v_xx + A * v * v_x), periodic finite differences
+            np.negative(v_field, out=du)
+            du -= conv_v
+            du += u_field
             if self.diffusion:
-                # diffusion_term = np.real(np.fft.ifft(-k**2 * v_hat))  # Multiply by k^2 for the second derivative in Fourier space
-                diffusion_term = finite_diff_diffusion(v_field, self.dx)
-            else:
-                diffusion_term = 0
-          
-            
-
-            u_field += dt /self.tau_u * (-u_field + conv_u + v_field + inputs[i, :])
-            u_field_full.append(u_field)
-            v_field += dt / self.tau_v * (-v_field - conv_v + u_field  + self.diffusion_coeff * diffusion_term + self.advection_coeff *v_field*advection_term)
-            v_field_full.append(v_field)
-            history_u[i, :] = u_field
-            history_v[i, :] = v_field
-        
-        return np.stack((history_u,history_v),axis=-1), t
-
-class AmariCoupledFHN(Dynamics):
-    def __init__(self,x_lim,dx,theta,eps,a,b,beta,tau_u,tau_v,kernel_types,kernel_pars):
+                self._diffusion(v_field, diff)
+                diff *= self.diffusion_coeff
+                du += diff
+            if self.advection:
+                self._advection(v_field, diff)
+                diff *= v_field
+                diff *= self.advection_coeff
+                du += diff
+            du *= dt / self.tau_v
+            v_field += du
+
+            recorder.record(i, u_field, v_field)
+
+    def _linear_part(self):
+        # -u / tau_u and (-v + D * v_xx) / tau_v, the finite difference Laplacian is diagonal in Fourier space
+        L_v = -1/self.tau_v
+        if self.diffusion:
+            k = np.arange(len(self.x) // 2 + 1)
+            laplacian = (2*np.cos(2*np.pi*k/len(self.x)) - 2) / self.dx**2
+            L_v = (-1 + self.diffusion_coeff * laplacian) / self.tau_v
+
+        return [-1/self.tau_u, L_v]
+
+    def _nonlinear(self, fields, inputs, i):
+        u_field, v_field = fields
+        f_hat_u = self._fold(self.sigmoid(u_field, self.beta, self.theta), np.empty((u_field.shape[0], len(self.x) // 2 + 1)))
+        conv_u = self._conv(f_hat_u, self.w_hat[0])
+        conv_v = self._conv(f_hat_u, self.w_hat[1])
+
+        N_v = u_field - conv_v
+        if self.advection:
+            N_v += self.advection_coeff * v_field * self._advection(v_field, np.empty_like(v_field))
+
+        return [(conv_u + v_field + inputs) / self.tau_u, N_v / self.tau_v]
+
+    def _advection(self, v, out):
+        # (v[j+1] - v[j-1]) / (2 dx)
+        np.subtract(v[..., 2:], v[..., :-2], out=out[..., 1:-1])
+        np.subtract(v[..., :1], v[..., -2:-1], out=out[..., -1:])
+        np.subtract(v[..., 1:2], v[..., -1:], out=out[..., :1])
+        return np.divide(out, 2 * self.dx, out=out)
+
+    def _diffusion(self, v, out):
+        # (v[j+1] - 2 v[j] + v[j-1]) / dx^2
+        np.multiply(v, -2., out=out)
+        out[..., :-1] += v[..., 1:]
+        out[..., -1:] += v[..., :1]
+        out[..., 1:] += v[..., :-1]
+        out[..., :1] += v[..., -1:]
+        return np.divide(out, self.dx**2, out=out)
+
+class AmariCoupledFHN(NeuralField):
+    _n_fields = 2 # u and v
+    def __init__(self,x_lim,dx,theta,eps,a,b,beta,tau_u,tau_v,kernel_types,kernel_pars,fft_workers=1,integrator="euler"):
         '''Two field Amari, S. I. (1977). Dynamics of pattern formation in lateral-inhibition type neural fields. Biological Cybernetics, 27(2), 77-87,'
         'implementation based on: https://github.com/w-wojtak/neural-fields-python?tab=readme-ov-file#1'''
 
-        super().__init__((int(np.round(x_lim/dx))+1,2), int(np.round(x_lim/dx)) +1)
-        self._method = "SM" # Spectral method, uses FFT-based convolutions
+        super().__init__((int(np.round(x_lim/dx))+1,2), int(np.round(x_lim/dx)) +1,
+                         np.arange(0,x_lim+dx,dx), dx, fft_workers, integrator)
         self.x_lim = x_lim
-        self.dx = dx
         self.theta = theta
-        self.x = np.arange(0,x_lim+dx,dx)
-        self.locations = self.x
         self.beta = beta
         self.tau_u = tau_u 
         self.tau_v = tau_v
         self.eps = eps
         self.a = a
         self.b = b
-        self.w_hat = []
 
         # kernels for u and v
-        for (kernel_type,kernel_par) in zip(kernel_types,kernel_pars):
-            if kernel_type == 0:
-                self.w_hat.append(np.fft.fft(self.kernel_gauss(self.x, *kernel_par)))
-            elif kernel_type == 1:
-                self.w_hat.append(np.fft.fft(self.kernel_mex(self.x, *kernel_par)))
-            elif kernel_type == 2:
-                self.w_hat.append(np.fft.fft(self.kernel_osc(self.x, *kernel_par)))
-            elif kernel_type == 3:
-                self.w_hat.append(np.fft.fft(self.kernel_cos(self.x, *kernel_par)))
-
-    def kernel_mex(self,x, a_ex, s_ex, a_in, s_in, w_in):
-        return a_ex * np.exp(-0.5 * x ** 2 / s_ex ** 2) - a_in * np.exp(-0.5 * x ** 2 / s_in ** 2) - w_in
-
-    def kernel_gauss(self,x, a_ex, s_ex, w_in):
-        return a_ex * np.exp(-0.5 * x ** 2 / s_ex ** 2) - w_in
-
-    def kernel_osc(self,x, a, b, alpha):
-        return a * (np.exp(-b*abs(x)) * ((b * np.sin(abs(alpha*x)))+np.cos(alpha*x)))
-    
-    def kernel_cos(self, x,A_1,A_2,a_1,a_2):
-        return (A_1*np.exp(-a_1* x ** 2 ) - A_2*np.exp(-a_2 * x ** 2)) * np.cos(x/2)
+        self.w_hat = [self.kernel_spectrum(self.kernel(kernel_type, kernel_par))
+                      for (kernel_type,kernel_par) in zip(kernel_types,kernel_pars)]
 
     def sigmoid(self,x, beta,theta):
         return 1 / (1 + np.exp(-beta * (x - theta)))
 
-    def simulate(self,x0,inputs,n_samples,time_horizon,init_time):
-
-        dt = (time_horizon-init_time)/inputs.shape[0]
-        t = np.arange(init_time,time_horizon,dt)
-        history_u = np.zeros([len(t), len(self.x)])
-        history_v = np.zeros([len(t), len(self.x)])
-
-        # IC
-        u_field = x0[:,0]
-        v_field = x0[:,1]
-
-
-        u_field_full = []
-        v_field_full = []
-        
-        for i in range(0, len(t)):
-            f_hat_u = self.sigmoid(u_field, self.beta, self.theta)
-            f_hat_v = self.sigmoid(v_field, self.beta, self.theta)
-            self.w_hat[0] *= 0.5  # Reduce kernel strength for coupling u
-            self.w_hat[1] *= 0.5  # Reduce kernel strength for coupling v
-            conv_uu = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat_u * self.w_hat[0])))
-            conv_uv = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat_v * self.w_hat[1])))
-            conv_vu = self.dx * np.fft.ifftshift(np.real(np.fft.ifft(f_hat_u * self.w_hat[1])))
-            conv_vu *= 0.1  # Reduce the interaction strength
-
-            u_field += dt /self.tau_u * (u_field - (1/3)*u_field**3 - v_field + conv_uu + inputs[i, :])
-            u_field_full.append(u_field)
-            v_field += (dt / self.tau_v) * self.eps * (u_field + self.a - self.b*v_field + conv_vu)
-            v_field_full.append(v_field)
-            history_u[i, :] = u_field
-            history_v[i, :] = v_field
-        
-        return np.stack((history_u,history_v),axis=-1), t
-
-
-class LIFBrian2(Dynamics):
-    def __init__(self,x_lim,tau,N,theta,refractory,reset_value,conduction_speed, kernel_type,kernel_pars,delta):
-        '''Leaky Integrate and Fire (LIF) neuron model simulated using Brian2: https://brian2.readthedocs.io/en/stable/'''
+    def _euler(self, x0, inputs, dt, n_steps, recorder):
+        u_field, v_field, rate, conv_uu, conv_vu, du, fold, work = self._workspace(x0.shape[0], 6, 1)
+        u_field[...] = x0[..., 0]
+        v_field[...] = x0[..., 1]
+
+        for i in range(0, n_steps):
+            f_hat_u = self._fold(self._sigmoid(u_field, self.beta, self.theta, rate), fold)
+            # Reduce kernel strength for coupling u and v, by half every step
+            scale = 0.5 ** (i + 1)
+            self._convolve(f_hat_u, self.w_hat[0], conv_uu, work)
+            conv_uu *= scale
+            self._convolve(f_hat_u, self.w_hat[1], conv_vu, work)
+            conv_vu *= 0.1 * scale  # Reduce the interaction strength
+
+            # u += dt/tau_u * (u - u^3/3 - v + conv_uu + input)
+            np.power(u_field, 3, out=du)
+            du *= -1/3
+            du += u_field
+            du -= v_field
+            du += conv_uu
+            du += inputs[:, i, :]
+            du *= dt / self.tau_u
+            u_field += du
+
+            # v += dt/tau_v * eps * (u + a - b v + conv_vu)
+            np.multiply(v_field, -self.b, out=du)
+            du += u_field
+            du += self.a
+            du += conv_vu
+            du *= dt / self.tau_v * self.eps
+            v_field += du
+
+            recorder.record(i, u_field, v_field)
+
+    def _linear_part(self):
+        return [1/self.tau_u, -self.eps*self.b/self.tau_v]
+
+    def _nonlinear(self, fields, inputs, i):
+        u_field, v_field = fields
+        f_hat_u = self._fold(self.sigmoid(u_field, self.beta, self.theta), np.empty((u_field.shape[0], len(self.x) // 2 + 1)))
+        scale = 0.5 ** (i + 1)
+        conv_uu = scale * self._conv(f_hat_u, self.w_hat[0])
+        conv_vu = 0.1 * scale * self._conv(f_hat_u, self.w_hat[1])
+
+        return [(-(1/3)*u_field**3 - v_field + conv_uu + inputs) / self.tau_u,
+                self.eps * (u_field + self.a + conv_vu) / self.tau_v]
+
+
+def _nearest_indices(grid, t):
+    '''Index of the element of the sorted grid nearest to each t (the earlier one on a tie).'''
+    right = np.clip(np.searchsorted(grid, t), 1, len(grid) - 1)
+    left = right - 1
+    return np.where(t - grid[left] <= grid[right] - t, left, right)
+
+
+def _index_pairs(n, offsets):
+    '''All pairs (i, j) of indices in range(n) with |i - j| in offsets, ordered by i and then j.'''
+    pre = np.concatenate([np.arange(n - m) for m in offsets] + [np.arange(m, n) for m in offsets] + [np.empty(0, int)])
+    post = np.concatenate([np.arange(m, n) for m in offsets] + [np.arange(n - m) for m in offsets] + [np.empty(0, int)])
+    order = np.lexsort((post, pre))
+    return pre[order], post[order]
+
+
+class LIFNetwork(Dynamics):
+    def __init__(self,x_lim,tau,N,theta,refractory,reset_value,conduction_speed, kernel_type,kernel_pars,delta,full_state_dt=None,connection_radius=None,weight_cutoff=None):
+        '''Ring of N Leaky Integrate and Fire (LIF) neurons with distance dependent synaptic weights and
+        conduction delays, shared by the Brian2 and NumPy simulators.
+
+        Only v is recorded: at the steps nearest to the sample times, and every full_state_dt ms
+        (by default the control step delta) for the full state.
+        Without connection_radius [mm] and weight_cutoff the neurons are connected all to all, otherwise only
+        within that distance and where the kernel weight is at least weight_cutoff in magnitude, see
+        connectivity_error for the difference with all to all connections.'''
         super().__init__(N, N)
-        self._method = "Brian2" 
         self.x_lim = x_lim * mm
         self.N = N
         self.theta = theta
@@ -726,27 +1302,14 @@ class LIFBrian2(Dynamics):
         self.conduction_speed = conduction_speed * mm / ms
         self.kernel_type = kernel_type
         self.kernel_pars = kernel_pars
+        self.connection_radius = None if connection_radius is None else connection_radius * mm
+        self.weight_cutoff = weight_cutoff
         self.delta = delta
-        neuron_spacing = self.x_lim / N
+        self.full_state_dt = delta if full_state_dt is None else full_state_dt
+        self.dt = 0.01*ms  # or whatever time resolution you need
+        self.neuron_spacing = self.x_lim / N
         self.tau = tau * ms
-        self.eqs =  '''     
-                    dv/dt = (I-v)/tau : 1 (unless refractory)
-                    I = stimulus(t,i)    : 1 # i == neuron index
-                    x : metre
-                    '''
-        self.G = NeuronGroup(self.N,self.eqs, threshold='v>theta', refractory=self.refractory*ms,reset='v=reset_value', method='euler',namespace={
-        'tau': self.tau,
-        'theta': self.theta,
-        'reset_value': self.reset_value})
-        defaultclock.dt = 0.01*ms  # or whatever time resolution you need
-
-        self.S = Synapses(self.G, self.G, """
-            w : 1
-             """,on_pre="v += w")
-        self.S.connect(condition='i!=j') # connect all to all except self to self
-
-        self.G.x = 'i*neuron_spacing' # create spatial locations for each neuron
-        self.locations = asarray(self.G.x) # locations of neurons in the network
+        self.locations = np.arange(self.N) * asarray(self.neuron_spacing) # locations of neurons in the network (in metre)
         
         def guassian_kernel(x):
             x = asarray(x)
@@ -821,12 +1384,13 @@ class LIFBrian2(Dynamics):
             return kernel
         
 
-        def traveling_wave_kernel(diff, direction='right', scale=1.0):
+        def traveling_wave_kernel(diff, pre, post, direction='right', scale=1.0):
             """
             Creates a directional (asymmetric) kernel for traveling waves.
 
             Parameters:
                 diff: np.array of absolute distances
+                pre, post: np.array of the neuron indices of the synapses
                 direction: 'right' or 'left' to control wave direction
                 scale: decay factor (smaller = sharper localization)
 
@@ -835,9 +1399,9 @@ class LIFBrian2(Dynamics):
             """
             diff = asarray(diff)
             if direction == 'right':
-                weights = np.where(self.S.j > self.S.i, np.exp(-diff / scale), 0.0)
+                weights = np.where(post > pre, np.exp(-diff / scale), 0.0)
             else:
-                weights = np.where(self.S.j < self.S.i, np.exp(-diff / scale), 0.0)
+                weights = np.where(post < pre, np.exp(-diff / scale), 0.0)
             return weights    
             
 
@@ -853,35 +1417,369 @@ class LIFBrian2(Dynamics):
         if kernel_type == 4:
             self.kernel = traveling_wave_kernel
 
-        diff = np.abs(self.G.x[self.S.i] - self.G.x[self.S.j])
-        diff_wrapped = np.minimum(diff, self.G.x[-1] - diff)
-        self.S.w[:] = self.kernel(diff_wrapped)
-        self.S.delay[:] = diff_wrapped / self.conduction_speed
-        # Uncomment to visualize the interconnections of the neurons
-        # visualise_connectivity(self.S)
-        self.Statemon = StateMonitor(self.G, variables=True, record=True) # record
-        self.net = Network(self.G, self.S, self.Statemon)  # for simulation purposes
-        self.net.store('initial')  # Save initial state (e.g., before first simulate call)
+    def _synapse_weights(self, pre, post):
+        # wrapped distances and kernel weights of the synapses pre -> post
+        diff = np.abs(self.locations[pre] - self.locations[post])
+        diff_wrapped = np.minimum(diff, self.locations[-1] - diff) * metre
+        if self.kernel_type == 4: # directional
+            return diff_wrapped, asarray(self.kernel(diff_wrapped, pre, post))
+        return diff_wrapped, asarray(self.kernel(diff_wrapped))
+
+    def _offsets(self):
+        '''The index distances |i - j| of the synapses: within connection_radius and, for the kernels that only
+        depend on the distance, with weights of at least weight_cutoff.'''
+        offsets = np.arange(1, self.N)
+        distances, weights = self._synapse_weights(np.zeros_like(offsets), offsets)
+        keep = np.ones(len(offsets), dtype=bool)
+        if self.connection_radius is not None:
+            keep &= asarray(distances) <= asarray(self.connection_radius)
+        if self.weight_cutoff is not None and self.kernel_type != 4:
+            keep &= np.abs(weights) >= self.weight_cutoff
+        return offsets[keep]
+
+    def _synapses(self):
+        '''Returns (pre, post, distances, weights) of the synapses of one copy, ordered by pre and then post.'''
+        pre, post = _index_pairs(self.N, self._offsets())
+        distances, weights = self._synapse_weights(pre, post)
+        if self.weight_cutoff is not None:
+            keep = np.abs(weights) >= self.weight_cutoff
+            pre, post, distances, weights = pre[keep], post[keep], distances[keep], weights[keep]
+        return pre, post, distances, weights
+
+    def connectivity_error(self):
+        '''Compares the synapses with all to all connections (except self to self). Returns the number of
+        synapses of both, the largest weight left out and the relative l2 error of the weight matrix.'''
+        kept = set(self._offsets().tolist())
+        dense_sq, error_sq, max_error = 0., 0., 0.
+        # one index distance at a time, so memory stays O(N)
+        for m in range(1, self.N):
+            _, weights = self._synapse_weights(*_index_pairs(self.N, [m]))
+            if m not in kept:
+                dropped = weights
+            elif self.weight_cutoff is not None:
+                dropped = weights[np.abs(weights) < self.weight_cutoff]
+            else:
+                dropped = weights[:0]
+            dense_sq += np.sum(weights**2)
+            error_sq += np.sum(dropped**2)
+            max_error = max(max_error, np.max(np.abs(dropped), initial=0.))
+
+        return {
+            "n_synapses": len(self._synapses()[0]),
+            "n_dense_synapses": self.N * (self.N - 1),
+            "max_abs_error": float(max_error),
+            "relative_l2_error": float(np.sqrt(error_sq / dense_sq)) if dense_sq > 0 else 0.,
+        }
+
+    def _time_grid(self, time_horizon, init_time, t_samples):
+        # number of simulation steps, their times in ms and the steps nearest to the sorted sample times
+        n_steps = int(np.round((time_horizon - init_time) * ms / self.dt))
+        # same floating point operations as the simulation clock, so the grid equals the recorded times
+        t_grid = np.arange(n_steps) * float(self.dt) * 1000
+        steps = None
+        if t_samples is not None:
+            steps = _nearest_indices(t_grid, np.asarray(t_samples) - init_time)
+        return n_steps, t_grid, steps
+
+    def _input_table(self, inputs):
+        '''Returns the inputs as an array (B, n_u, N) and the time step (in ms) of its rows. If every
+        input is a PiecewiseConstant holding all its values for the same number of control steps, the
+        rows are those values, otherwise they are the inputs of every control step.'''
+        holds = [u.uniform_hold() if isinstance(u, PiecewiseConstant) else None for u in inputs]
+        if holds[0] is not None and all(h == holds[0] and u.values.shape == inputs[0].values.shape
+                                        for h, u in zip(holds, inputs)):
+            return np.stack([u.values for u in inputs]).astype(float), holds[0] * self.delta
+        return np.asarray(inputs, dtype=float), self.delta
 
     def simulate(self, x, u,n_samples,time_horizon,init_time):
-        self.net.restore('initial')
-        self.G.v = x # initial condition
-        stimulus = TimedArray(u, dt=self.delta*ms)
-        duration = (time_horizon - init_time) * ms 
-        self.net.run(duration)
+        '''Returns v of shape (N, n_times), recorded every full_state_dt, and the times in ms.'''
+        history, t, _, _ = self.simulate_batch(np.asarray(x)[None], [u], n_samples,
+                                               time_horizon, init_time)
         # Uncomment to visualize the trajectory
-        # plot_spatio_temporal_slices(self.Statemon.v)
-        # heatmap_1D_adj_2(self.Statemon.v,self.Statemon.I,self.G.x,self.Statemon.t)
-        # plot_slider_1d(self.Statemon.v,self.Statemon.I)
-        # heatmap_1D(self.Statemon.v,self.Statemon.I)
-        # plot_fixed_views(self.Statemon.v)
-        # plot_animate_1d(self.Statemon.v,self.theta,self.Statemon.I)
-        y, t = asarray(self.Statemon.v), asarray(self.Statemon.t) * 1000 # convert from s to ms (asarray returns it in seconds)
-        return y, t
-
+        # plot_spatio_temporal_slices(history[0].T)
+        # plot_fixed_views(history[0].T)
+        return history[0].T, t
+
+
+class LIFBrian2(LIFNetwork):
+    def __init__(self,x_lim,tau,N,theta,refractory,reset_value,conduction_speed, kernel_type,kernel_pars,delta,device="runtime",openmp_threads=0,full_state_dt=None,n_copies=1,connection_radius=None,weight_cutoff=None):
+        '''LIF network (see LIFNetwork) simulated using Brian2: https://brian2.readthedocs.io/en/stable/
+
+        device "runtime" runs the network from Python, "cpp_standalone" compiles it into a C++ program
+        (with openmp_threads threads) on the first trajectory and reruns that program for the next ones,
+        which then need the same time horizon, input length and full_state.
+        The network holds n_copies independent copies of the ring, which simulate_batch uses to simulate
+        that many trajectories in one run.'''
+        super().__init__(x_lim,tau,N,theta,refractory,reset_value,conduction_speed,kernel_type,kernel_pars,delta,
+                         full_state_dt,connection_radius,weight_cutoff)
+        self._method = "Brian2" 
+        self.device = device
+        self.stimulus = None # TimedArray of the inputs, reused between trajectories
+        self._standalone_build = None # (duration, input shape and step, full_state) the standalone program was compiled for
+        self._build_dir = None
+        if device == "cpp_standalone":
+            set_device('cpp_standalone', build_on_run=False)
+            prefs.devices.cpp_standalone.openmp_threads = openmp_threads
+        self.n_copies = n_copies
+        self.sample_steps = None # TimedArray flagging the simulation steps at which v is sampled
+        neuron_spacing = self.neuron_spacing
+        self.eqs =  '''     
+                    dv/dt = (I-v)/tau : 1 (unless refractory)
+                    I = stimulus(t,i)    : 1 # i == neuron index
+                    x : metre
+                    '''
+        # neuron i is neuron i % N of copy i // N
+        self.G = NeuronGroup(self.N*n_copies,self.eqs, threshold='v>theta', refractory=self.refractory*ms,reset='v=reset_value', method='euler',namespace={
+        'tau': self.tau,
+        'theta': self.theta,
+        'reset_value': self.reset_value,
+        'n_neurons': self.N},
+        events={'sample': 'sample_step(t, i // n_neurons) > 0'})
+        # detect (and record) the sample event at the start of a step, before v is updated
+        self.G.set_event_schedule('sample', when='start')
+        defaultclock.dt = self.dt
 
+        self.S = Synapses(self.G, self.G, """
+            w : 1
+             """,on_pre="v += w")
 
+        self.G.x = '(i % n_neurons)*neuron_spacing' # create spatial locations for each neuron
 
+        # the pairs are built here rather than from a condition, because a cpp_standalone network
+        # cannot be read back before it has run
+        pre, post, diff_wrapped, weights = self._synapses()
+        # the same connections within every copy, none between copies
+        offsets = np.repeat(np.arange(n_copies) * self.N, len(pre))
+        self.S.connect(i=np.tile(pre, n_copies) + offsets, j=np.tile(post, n_copies) + offsets)
+        self.S.w[:] = np.tile(weights, n_copies)
+        self.S.delay[:] = np.tile(asarray(diff_wrapped / self.conduction_speed), n_copies) * second
+        # Uncomment to visualize the interconnections of the neurons
+        # visualise_connectivity(self.S)
+        self.Samplemon = EventMonitor(self.G, 'sample', variables=['v'], when='start', order=1) # v at the sample times
+        self.Statemon = StateMonitor(self.G, 'v', record=True, dt=self.full_state_dt*ms) # downsampled full state
+        self.net = Network(self.G, self.S, self.Samplemon, self.Statemon)  # for simulation purposes
+        if device == "runtime":
+            self.net.store('initial')  # Save initial state (e.g., before first simulate call)
+
+    def _set_stimulus(self, u, u_dt):
+        # Changing the values of one TimedArray, rather than creating a new (differently named) one,
+        # keeps the generated code the same, so Brian2 reuses the compiled code objects.
+        if (self.stimulus is None or self.stimulus.values.shape != np.shape(u)
+                or self.stimulus.dt != float(u_dt*ms)):
+            self.stimulus = TimedArray(np.array(u, dtype=float), dt=u_dt*ms)
+            self.G.namespace['stimulus'] = self.stimulus
+        else:
+            self.stimulus.values[:] = u
+
+    def _set_sample_steps(self, flags):
+        # same reuse as for the stimulus
+        if self.sample_steps is None or self.sample_steps.values.shape != flags.shape:
+            self.sample_steps = TimedArray(flags, dt=defaultclock.dt)
+            self.G.namespace['sample_step'] = self.sample_steps
+        else:
+            self.sample_steps.values[:] = flags
+
+    def _run_standalone(self, x, u, u_dt, flags, duration, full_state):
+        if self._standalone_build is None:
+            # an inactive monitor is left out of the compiled program
+            self.Statemon.active = full_state
+            self._set_stimulus(u, u_dt)
+            self._set_sample_steps(flags)
+            self.net.run(duration)
+            # every instance (e.g. one per worker process) builds in its own directory
+            self._build_dir = tempfile.mkdtemp(prefix="lif_brian2_")
+            device.build(directory=self._build_dir, run=False) # generate and compile the C++ program
+            self._standalone_build = (duration, np.shape(u), u_dt, full_state)
+        elif self._standalone_build != (duration, np.shape(u), u_dt, full_state):
+            raise ValueError("A cpp_standalone LIFBrian2 is compiled for one time horizon, input length and step and full_state.")
+
+        # only the initial voltages, the inputs and the sample steps change between runs of the program
+        device.run(with_output=False, run_args={self.G.v: np.asarray(x, dtype=float),
+                                                 self.stimulus: np.asarray(u, dtype=float),
+                                                 self.sample_steps: flags})
+
+    def simulate_batch(self,x0,inputs,n_samples,time_horizon,init_time,t_samples=None,full_state=True):
+        '''Simulates B initial states x0 with inputs (B, n_steps, N), n_copies at a time. Returns
+        (history, t, samples, t_samples) as NeuralField.simulate_batch: v every full_state_dt (None unless
+        full_state) at the times t, and v at the simulation steps nearest to the sorted sample times
+        t_samples (B, n_s) (None if not given) together with the times of those steps, in ms from the start.
+        inputs can also be a list of PiecewiseConstant, which the stimulus then holds without expanding.'''
+        duration = (time_horizon - init_time) * ms
+        n_steps, t_grid, steps = self._time_grid(time_horizon, init_time, t_samples)
+        inputs, u_dt = self._input_table(inputs)
+
+        history, samples = [], []
+        for k in range(0, len(x0), self.n_copies):
+            batch = slice(k, k + self.n_copies)
+            h, t, y = self._simulate_copies(x0[batch], inputs[batch], u_dt,
+                                            None if steps is None else steps[batch], n_steps, duration,
+                                            full_state)
+            history.append(h)
+            samples.append(y)
+
+        history = np.concatenate(history) if full_state else None
+        if steps is None:
+            return history, t, None, None
+        return history, t, np.concatenate(samples), t_grid[steps]
+
+    def _simulate_copies(self, x0, inputs, u_dt, steps, n_steps, duration, full_state):
+        # the copies beyond the batch start at rest without input
+        b, n_u = len(x0), inputs.shape[1]
+        x = np.zeros((self.n_copies, self.N))
+        x[:b] = x0
+        u = np.zeros((n_u, self.n_copies, self.N))
+        u[:, :b] = np.swapaxes(inputs, 0, 1)
+        u = u.reshape(n_u, -1)
+        flags = np.zeros((n_steps, self.n_copies))
+        for k in range(b if steps is not None else 0):
+            flags[steps[k], k] = 1.
+
+        if self.device == "cpp_standalone":
+            self._run_standalone(x.reshape(-1), u, u_dt, flags, duration, full_state)
+        else:
+            self.Statemon.active = full_state
+            self.net.restore('initial')
+            self.G.v = x.reshape(-1) # initial condition
+            self._set_stimulus(u, u_dt)
+            self._set_sample_steps(flags)
+            self.net.run(duration)
+
+        history, t, samples = None, None, None
+        if full_state:
+            history = np.swapaxes(asarray(self.Statemon.v).reshape(self.n_copies, self.N, -1)[:b], 1, 2)
+            t = asarray(self.Statemon.t) * 1000 # convert from s to ms (asarray returns it in seconds)
+        if steps is not None:
+            # the events of one step are stored in neuron order
+            copy = asarray(self.Samplemon.i) // self.N
+            v = asarray(self.Samplemon.v)
+            samples = []
+            for k in range(b):
+                recorded, index = np.unique(steps[k], return_inverse=True)
+                samples.append(v[copy == k].reshape(len(recorded), self.N)[index])
+        return history, t, samples
+
+
+class LIFNumpy(LIFNetwork):
+    def __init__(self,x_lim,tau,N,theta,refractory,reset_value,conduction_speed, kernel_type,kernel_pars,delta,full_state_dt=None,connection_radius=None,weight_cutoff=None):
+        '''LIF network (see LIFNetwork) stepped with NumPy, all trajectories of a batch together. Every step
+        follows the schedule of LIFBrian2: Euler step of v (except when refractory), threshold, synaptic
+        transmission (not to refractory neurons) and reset. Delayed synaptic input is accumulated in a ring
+        buffer with a slot per delay step.'''
+        super().__init__(x_lim,tau,N,theta,refractory,reset_value,conduction_speed,kernel_type,kernel_pars,delta,
+                         full_state_dt,connection_radius,weight_cutoff)
+        self._method = "Numpy"
+        dt = float(self.dt)
+        self._decay = dt / float(self.tau)
+        # rounded as Brian2 does
+        self._refractory_steps = int((float(self.refractory*ms) + 1e-3*dt) / dt)
+        self._full_state_every = int(np.round(self.full_state_dt*ms / self.dt))
+
+        pre, self._post, distances, self._weights = self._synapses()
+        self._delays = np.round(asarray(distances / self.conduction_speed) / dt).astype(int)
+        self._n_slots = self._delays.max(initial=0) + 1
+        # the synapses of neuron i are _syn_start[i]:_syn_start[i+1], as they are ordered by pre
+        self._syn_start = np.searchsorted(pre, np.arange(self.N + 1))
+
+    def _transmit(self, spikes, k, buffer):
+        # adds the weights of the synapses of the spiking neurons to the slots of their delays
+        b, i = np.nonzero(spikes)
+        start, count = self._syn_start[i], np.diff(self._syn_start)[i]
+        first = np.cumsum(count) - count
+        syn = np.arange(count.sum()) - np.repeat(first - start, count)
+        slot = (k + self._delays[syn]) % self._n_slots
+        np.add.at(buffer, (slot, np.repeat(b, count), self._post[syn]), self._weights[syn])
+
+    def simulate_batch(self,x0,inputs,n_samples,time_horizon,init_time,t_samples=None,full_state=True):
+        '''Simulates B initial states x0 with inputs (B, n_steps, N) (or a list of PiecewiseConstant)
+        together. Returns (history, t, samples, t_samples) as LIFBrian2.simulate_batch.'''
+        n_steps, t_grid, steps = self._time_grid(time_horizon, init_time, t_samples)
+        B = len(x0)
+        inputs, u_dt = self._input_table(inputs)
+        # input of every step, looked up as by a Brian2 TimedArray with step u_dt: on a grid K times finer
+        # than u_dt, with K a power of two of at least 8 times the ratio of u_dt and the simulation step
+        delta, dt = float(u_dt*ms), float(self.dt)
+        K = max(int(2 ** np.ceil(np.log2(8 / dt * delta))), 1)
+        u_index = np.minimum(((np.arange(n_steps) * dt / (delta / K) + 0.5) / K).astype(int),
+                             inputs.shape[1] - 1)
+
+        # the (trajectory, sample) pairs recorded at every sampled step
+        record = {}
+        if steps is not None:
+            samples = np.empty((B, steps.shape[1], self.N))
+            for (b, j), k in np.ndenumerate(steps):
+                record.setdefault(k, ([], []))
+                record[k][0].append(b)
+                record[k][1].append(j)
+        if full_state:
+            history = np.empty((B, len(range(0, n_steps, self._full_state_every)), self.N))
+
+        v = np.array(x0, dtype=float)
+        last_spike = np.full((B, self.N), -self._refractory_steps) # not refractory at the start
+        buffer = np.zeros((self._n_slots, B, self.N))
+        for k in range(n_steps):
+            # record at the start of the step
+            if full_state and k % self._full_state_every == 0:
+                history[:, k // self._full_state_every] = v
+            if k in record:
+                b, j = record[k]
+                samples[b, j] = v[b]
+
+            not_refractory = k - last_spike >= self._refractory_steps
+            v = np.where(not_refractory, self._decay * (inputs[:, u_index[k]] - v) + v, v)
+
+            spikes = (v > self.theta) & not_refractory
+            last_spike[spikes] = k
+            not_refractory &= ~spikes
+            if spikes.any():
+                self._transmit(spikes, k, buffer)
+
+            slot = k % self._n_slots
+            v = np.where(not_refractory, v + buffer[slot], v)
+            buffer[slot] = 0.
+            v[spikes] = self.reset_value
+
+        history, t = (history, np.arange(history.shape[1]) * float(self.full_state_dt*ms) * 1000) if full_state else (None, None)
+        if steps is None:
+            return history, t, None, None
+        return history, t, samples, t_grid[steps]
+
+
+def _rate_expm1(c, z, s):
+    '''Gating rate c * z / (exp(-z / s) - 1) and its derivative w.r.t. z.'''
+    e = np.exp(-z / s)
+
+    return c * z / (e - 1), c / (e - 1) + c * z * e / (s * (e - 1)**2)
+
+
+def _hh_gates_jac(v, v_t, n, m, h):
+    '''Derivatives of (dn, dm, dh) w.r.t. (n, m, h) and w.r.t. the denormalised voltage.'''
+    a_n, da_n = _rate_expm1(-0.032, v - v_t - 15., 5.)
+    b_n = 0.5 * np.exp(-(v - v_t - 10.) / 40.)
+
+    a_m, da_m = _rate_expm1(-0.32, v - v_t - 13., 4.)
+    b_m, db_m = _rate_expm1(0.28, v - v_t - 40., -5.)
+
+    a_h = 0.128 * np.exp(-(v - v_t - 17.) / 18.)
+    e_h = np.exp(-(v - v_t - 40.) / 5.)
+    b_h = 4. / (1. + e_h)
+
+    d_gate = np.array((-(a_n + b_n), -(a_m + b_m), -(a_h + b_h)))
+    d_v = np.array((da_n * (1. - n) + b_n / 40. * n,
+                    da_m * (1. - m) - db_m * m,
+                    -a_h / 18. * (1. - h) - 4. * e_h / (5. * (1. + e_h)**2) * h))
+
+    return d_gate, d_v
+
+
+def _hh_p_jac(v, p, t_max):
+    '''Derivatives of dp w.r.t. p and w.r.t. the denormalised voltage.'''
+    w = v + 35.
+    e = np.exp(-w / 10.)
+    p_inf = 1. / (1. + e)
+    inv_t_p = (3.3 * np.exp(w / 20.) + np.exp(-w / 20.)) / t_max
+    d_inv_t_p = (3.3 * np.exp(w / 20.) - np.exp(-w / 20.)) / (20. * t_max)
+
+    return -inv_t_p, e / (10. * (1. + e)**2) * inv_t_p + (p_inf - p) * d_inv_t_p
 
 
 _dynamics_names = {
@@ -901,6 +1799,7 @@ _dynamics_names = {
     "AmariCoupled":AmariCoupled,
     "AmariCoupledFHN":AmariCoupledFHN,
     "LIFBrian2":LIFBrian2,
+    "LIFNumpy":LIFNumpy,
 }
 
 
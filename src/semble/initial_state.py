@@ -13,6 +13,19 @@ class InitialStateGenerator:
     def sample(self):
         return self._sample_impl()
 
+    def sample_batch(self, batch_size):
+        '''Returns batch_size initial states as one (batch_size, ...) array.
+        Draws from the same generators as sample(), but the values may differ
+        from batch_size calls to sample() for the same seed.'''
+        return self._sample_batch_impl(batch_size)
+
+    def _sample_batch_impl(self, batch_size):
+        # one state at a time, unless a generator draws the whole batch at once
+        return np.stack([self._sample_impl() for _ in range(batch_size)])
+
+    def reset_rng(self, seed=None):
+        self._rng = np.random.default_rng(seed)
+
 
 class GaussianInitialState(InitialStateGenerator):
 
@@ -23,6 +36,9 @@ class GaussianInitialState(InitialStateGenerator):
     def _sample_impl(self):
         return self._rng.standard_normal(size=self.n)
 
+    def _sample_batch_impl(self, batch_size):
+        return self._rng.standard_normal(size=(batch_size, self.n))
+
 
 class UniformInitialState(InitialStateGenerator):
 
@@ -33,6 +49,9 @@ class UniformInitialState(InitialStateGenerator):
     def _sample_impl(self):
         return self._rng.uniform(size=self.n)
 
+    def _sample_batch_impl(self, batch_size):
+        return self._rng.uniform(size=(batch_size, self.n))
+
 
 class HHFSInitialState(InitialStateGenerator):
 
@@ -45,6 +64,12 @@ class HHFSInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0 = self._rng.uniform(size=(batch_size, 4))
+        x0[:, 0] = 2. * x0[:, 0] - 1.
+
+        return x0
+
 
 class HHRSAInitialState(InitialStateGenerator):
 
@@ -57,6 +82,12 @@ class HHRSAInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0 = self._rng.uniform(size=(batch_size, 5))
+        x0[:, 0] = 2. * x0[:, 0] - 1.
+
+        return x0
+
 
 class HHFFEInitialState(InitialStateGenerator):
 
@@ -70,6 +101,13 @@ class HHFFEInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0 = self._rng.uniform(size=(batch_size, 10))
+        x0[:, 0] = 2. * x0[:, 0] - 1.
+        x0[:, 5] = 2. * x0[:, 5] - 1.
+
+        return x0
+
 
 class HHFBEInitialState(InitialStateGenerator):
 
@@ -83,6 +121,13 @@ class HHFBEInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0 = self._rng.uniform(size=(batch_size, 11))
+        x0[:, 0] = 2. * x0[:, 0] - 1.
+        x0[:, 5] = 2. * x0[:, 5] - 1.
+
+        return x0
+
 
 class HHIBInitialState(InitialStateGenerator):
 
@@ -95,6 +140,12 @@ class HHIBInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0 = self._rng.uniform(size=(batch_size, 7))
+        x0[:, 0] = 2. * x0[:, 0] - 1.
+
+        return x0
+
 
 class GreenshieldsInitialState(InitialStateGenerator):
 
@@ -113,6 +164,14 @@ class GreenshieldsInitialState(InitialStateGenerator):
 
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        x0_vals = self._rng.uniform(0., 0.5, size=(batch_size, self.n_sec))
+        x0 = np.empty((batch_size, self.n_cells))
+        x0[:, 0:self.sec_size * self.n_sec] = np.repeat(x0_vals, self.sec_size, axis=1)
+        x0[:, self.sec_size * self.n_sec:-1] = x0[:, self.sec_size * self.n_sec - 1:self.sec_size * self.n_sec]
+
+        return x0
+
 class HeatInitialState(InitialStateGenerator):
     def __init__(self, n, L, rng: np.random.Generator = None):
         super().__init__(rng)
@@ -129,6 +188,14 @@ class HeatInitialState(InitialStateGenerator):
         
         return x0
 
+    def _sample_batch_impl(self, batch_size):
+        firstpeak = np.random.uniform(0.1*self.L, 0.9*self.L, size=(batch_size, 1))
+        secondpeak = np.random.uniform(0.1*self.L, 0.9*self.L, size=(batch_size, 1))
+        x0 = 5*np.exp(-(self.x_points - firstpeak)**2 / (2 * self.sigma**2))
+        x0 += 5*np.exp(-(self.x_points - secondpeak+2)**2 / (2 * self.sigma**2))
+
+        return x0
+
 class AmariInitialState(InitialStateGenerator):
     def __init__(self,x_lim,dx,rng: np.random.Generator = None):
         '''returns empty array'''
@@ -195,6 +262,17 @@ class LifInitialState(InitialStateGenerator):
             v0 += 0.45 * np.exp(-0.5 * (distance / width) ** 2)
 
         return v0
+
+    def _sample_batch_impl(self, batch_size):
+        x = np.arange(self.N)
+        width = self._rng.uniform(5, 15, size=(batch_size, self.bumps, 1))
+        center = self._rng.integers(0, self.N, size=(batch_size, self.bumps, 1))
+        distance = np.minimum(
+            np.abs(x - center),
+            self.N - np.abs(x - center)
+            )
+
+        return np.sum(0.45 * np.exp(-0.5 * (distance / width) ** 2), axis=1)
     
 _initstategen_names = {
     "GaussianInitialState": GaussianInitialState,
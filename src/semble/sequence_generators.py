@@ -1,6 +1,51 @@
 import numpy as np
 from brian2 import *
 
+
+class PiecewiseConstant:
+    '''Compact form of a control sequence that holds values[k] for holds[k] control steps, i.e. of
+    np.repeat(values, holds, axis=0). Indexing with a control step gives the control at that step and
+    numpy converts it to the full sequence.'''
+
+    def __init__(self, values, holds):
+        self.values = np.asarray(values)
+        self.holds = np.asarray(holds, dtype=int)
+
+    def __len__(self):
+        return int(self.holds.sum())
+
+    @property
+    def shape(self):
+        return (len(self), ) + self.values.shape[1:]
+
+    def value_index(self, steps):
+        '''Index into values of the control step(s).'''
+        return np.searchsorted(np.cumsum(self.holds), steps, side='right')
+
+    def __getitem__(self, step):
+        return self.values[self.value_index(step)]
+
+    def expand(self):
+        return np.repeat(self.values, self.holds, axis=0)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.expand() if dtype is None else self.expand().astype(dtype)
+
+    def uniform_hold(self):
+        '''The hold shared by all values (the last one may be cut short), None if they differ.'''
+        if len(self.holds) and (self.holds[:-1] == self.holds[0]).all() and self.holds[-1] <= self.holds[0]:
+            return int(self.holds[0])
+        return None
+
+
+def _hold(amp_seq, period, n_control_vals, compact):
+    # every amplitude held for period control steps, the last one cut off at n_control_vals
+    if compact:
+        holds = np.minimum(period, n_control_vals - period * np.arange(len(amp_seq)))
+        return PiecewiseConstant(amp_seq, holds)
+    return np.repeat(amp_seq, period, axis=0)[:n_control_vals]
+
+
 class SequenceGenerator:
 
     def __init__(self, dim, rng: np.random.Generator = None):
@@ -14,6 +59,20 @@ class SequenceGenerator:
     def sample(self, time_range, delta):
         return self._sample_impl(time_range, delta)
 
+    def sample_batch(self, batch_size, time_range, delta):
+        '''Returns batch_size sequences as one (batch_size, n_control_vals, dim) array (also for
+        generators set to sample compact sequences).
+        Draws from the same generators as sample(), but the values may differ
+        from batch_size calls to sample() for the same seed.'''
+        return self._sample_batch_impl(batch_size, time_range, delta)
+
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        # one sequence at a time, unless a generator draws the whole batch at once
+        return np.stack([self._sample_impl(time_range, delta) for _ in range(batch_size)])
+
+    def reset_rng(self, seed=None):
+        self._rng = np.random.default_rng(seed)
+
 
 class Product(SequenceGenerator):
 
@@ -21,10 +80,23 @@ class Product(SequenceGenerator):
         super().__init__(len(seq_gens), rng)
         self._seq_gens = seq_gens
 
+    def reset_rng(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = seed.spawn(len(self._seq_gens) + 1)
+        super().reset_rng(seeds[0])
+        for g, g_seed in zip(self._seq_gens, seeds[1:]):
+            g.reset_rng(g_seed)
+
     def _sample_impl(self, time_range, delta):
         samples = tuple(g.sample(time_range, delta) for g in self._seq_gens)
 
         return np.hstack(samples)
+
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        samples = tuple(g.sample_batch(batch_size, time_range, delta) for g in self._seq_gens)
+
+        return np.concatenate(samples, axis=-1)
     
 class Spatial(SequenceGenerator):
 
@@ -32,11 +104,24 @@ class Spatial(SequenceGenerator):
         super().__init__(len(seq_gens), rng)
         self._seq_gens = seq_gens
 
+    def reset_rng(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = seed.spawn(len(self._seq_gens) + 1)
+        super().reset_rng(seeds[0])
+        for g, g_seed in zip(self._seq_gens, seeds[1:]):
+            g.reset_rng(g_seed)
+
     def _sample_impl(self, time_range, delta):
         samples = tuple(g.sample(time_range, delta) for g in self._seq_gens)
 
         return np.hstack(samples)
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        samples = tuple(g.sample_batch(batch_size, time_range, delta) for g in self._seq_gens)
+
+        return np.concatenate(samples, axis=-1)
+
 
 class GaussianSequence(SequenceGenerator):
 
@@ -55,13 +140,21 @@ class GaussianSequence(SequenceGenerator):
 
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+        return self._rng.normal(loc=self._mean,
+                                scale=self._std,
+                                size=(batch_size, n_control_vals, self.dim))
+
 
 class GaussianSqWave(SequenceGenerator):
 
-    def __init__(self, period, mean=0., std=1., dim=1, rng=None):
+    def __init__(self, period, mean=0., std=1., dim=1, compact=False, rng=None):
         super().__init__(dim, rng)
 
         self._period = period
+        self._compact = compact  # sample PiecewiseConstant sequences
         self._mean = mean
         self._std = std
 
@@ -75,16 +168,27 @@ class GaussianSqWave(SequenceGenerator):
                                    scale=self._std,
                                    size=(n_amplitude_vals, self.dim))
 
-        control_seq = np.repeat(amp_seq, self._period, axis=0)[:n_control_vals]
+        control_seq = _hold(amp_seq, self._period, n_control_vals, self._compact)
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+        n_amplitude_vals = int(np.ceil(n_control_vals / self._period))
+
+        amp_seq = self._rng.normal(loc=self._mean, scale=self._std,
+                                   size=(batch_size, n_amplitude_vals, self.dim))
+
+        return np.repeat(amp_seq, self._period, axis=1)[:, :n_control_vals]
+
 
 class LogNormalSqWave(SequenceGenerator):
 
-    def __init__(self, period, mean=0., std=1., dim=1, rng=None):
+    def __init__(self, period, mean=0., std=1., dim=1, compact=False, rng=None):
         super().__init__(dim, rng)
 
         self._period = period
+        self._compact = compact  # sample PiecewiseConstant sequences
         self._mean = mean
         self._std = std
 
@@ -98,17 +202,28 @@ class LogNormalSqWave(SequenceGenerator):
                                       sigma=self._std,
                                       size=(n_amplitude_vals, self.dim))
 
-        control_seq = np.repeat(amp_seq, self._period, axis=0)[:n_control_vals]
+        control_seq = _hold(amp_seq, self._period, n_control_vals, self._compact)
 
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+        n_amplitude_vals = int(np.ceil(n_control_vals / self._period))
+
+        amp_seq = self._rng.lognormal(mean=self._mean, sigma=self._std,
+                                      size=(batch_size, n_amplitude_vals, self.dim))
+
+        return np.repeat(amp_seq, self._period, axis=1)[:, :n_control_vals]
+
 
 class UniformSqWave(SequenceGenerator):
 
-    def __init__(self, period, min=0., max=1., dim=1, rng=None):
+    def __init__(self, period, min=0., max=1., dim=1, compact=False, rng=None):
         super().__init__(dim, rng)
 
         self._period = period
+        self._compact = compact  # sample PiecewiseConstant sequences
         self._min = min
         self._max = max
 
@@ -122,10 +237,20 @@ class UniformSqWave(SequenceGenerator):
                                     high=self._max,
                                     size=(n_amplitude_vals, self.dim))
 
-        control_seq = np.repeat(amp_seq, self._period, axis=0)[:n_control_vals]
+        control_seq = _hold(amp_seq, self._period, n_control_vals, self._compact)
 
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+        n_amplitude_vals = int(np.ceil(n_control_vals / self._period))
+
+        amp_seq = self._rng.uniform(low=self._min, high=self._max,
+                                    size=(batch_size, n_amplitude_vals, self.dim))
+
+        return np.repeat(amp_seq, self._period, axis=1)[:, :n_control_vals]
+
 
 class RandomWalkSequence(SequenceGenerator):
 
@@ -147,6 +272,16 @@ class RandomWalkSequence(SequenceGenerator):
 
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+
+        return np.cumsum(self._rng.normal(loc=self._mean,
+                                          scale=self._std,
+                                          size=(batch_size, n_control_vals,
+                                                self.dim)),
+                         axis=2)
+
 
 class SinusoidalSequence(SequenceGenerator):
 
@@ -169,6 +304,18 @@ class SinusoidalSequence(SequenceGenerator):
         return (amplitude * np.sin(np.pi * frequency / delta * time)).reshape(
             (-1, 1))
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        amplitude = self._rng.lognormal(mean=self._amp_mean,
+                                        sigma=self._amp_std,
+                                        size=(batch_size, 1))
+        frequency = self._rng.uniform(0, self._mf, size=(batch_size, 1))
+
+        n_control_vals = int(1 +
+                             np.floor((time_range[1] - time_range[0]) / delta))
+        time = np.linspace(time_range[0], time_range[1], n_control_vals)
+
+        return (amplitude * np.sin(np.pi * frequency / delta * time))[..., None]
+
 class Gaussian1D(SequenceGenerator):
     '''input used for the amari model, contains several guassians'''
     def __init__(self,x_lim,dx,duration,amplitude,std,difference):
@@ -214,11 +361,12 @@ class Gaussian1D(SequenceGenerator):
 
 class LIF_input(SequenceGenerator):
 
-    def __init__(self,step,magnitudes,period,dim,amplitude,std,rng=None):
+    def __init__(self,step,magnitudes,period,dim,amplitude,std,compact=False,rng=None):
         super().__init__(dim, rng)
         self.step = step
         self.period = period
         self._period = period
+        self._compact = compact  # sample PiecewiseConstant sequences
         self._min, self._max = magnitudes
         self.amplitude = amplitude
         self.std = std
@@ -233,26 +381,42 @@ class LIF_input(SequenceGenerator):
                                 high=self._max,
                                 size=(n_amplitude_vals, 1)) 
 
-            for i in range(n_amplitude_vals):
-                # Randomly choose a starting index for the std-neuron segment
-                start_idx = numpy.random.randint(0, self.dim - self.std)
-                # Set the std consecutive neurons to the original random value
-                amp_seq[i, 0:] = mask_amp_seq[i, 0]  # Use the random value from t
+            # Randomly choose a starting index for the std-neuron segment (unused, but kept for the global RNG state)
+            numpy.random.randint(0, self.dim - self.std, size=n_amplitude_vals)
+            amp_seq[:] = mask_amp_seq  # Use the random value from t
 
         else: # guassian over space
             neuron_indices = np.arange(self.dim)
             mu = numpy.random.randint(low=neuron_indices[0], high=neuron_indices[-1], size=n_amplitude_vals) # random neuron locations
             magnitude = numpy.random.uniform(low=self._min, high=self._max, size=n_amplitude_vals) # random magnitudes
-            for i,mean in enumerate(mu):
-                distance = np.minimum(
-                    np.abs(neuron_indices - mean),
-                    self.dim - np.abs(neuron_indices - mean)
-                    )
-                amp_seq[i] = magnitude[i] * np.exp(-0.5 * (distance ** 2) / self.std ** 2)
-
-        control_seq = np.repeat(amp_seq, self._period, axis=0)[:n_control_vals]
+            amp_seq = self._bumps(mu, magnitude)
+
+        control_seq = _hold(amp_seq, self._period, n_control_vals, self._compact)
         return control_seq
 
+    def _sample_batch_impl(self, batch_size, time_range, delta):
+        n_control_vals = int(1+np.floor((time_range[1] - time_range[0]) / delta))
+        n_amplitude_vals = int(np.ceil(n_control_vals / self._period))
+        shape = (batch_size, n_amplitude_vals)
+
+        if self.step:
+            amp_seq = np.repeat(self._rng.uniform(low=self._min, high=self._max, size=shape + (1,)), self.dim, axis=2)
+        else:
+            mu = numpy.random.randint(low=0, high=self.dim - 1, size=shape)
+            magnitude = numpy.random.uniform(low=self._min, high=self._max, size=shape)
+            amp_seq = self._bumps(mu, magnitude)
+
+        return np.repeat(amp_seq, self._period, axis=1)[:, :n_control_vals]
+
+    def _bumps(self, mu, magnitude):
+        # gaussians over the ring of neurons, centred at the neurons mu
+        neuron_indices = np.arange(self.dim)
+        distance = np.minimum(
+            np.abs(neuron_indices - mu[..., None]),
+            self.dim - np.abs(neuron_indices - mu[..., None])
+            )
+        return magnitude[..., None] * np.exp(-0.5 * (distance ** 2) / self.std ** 2)
+
     
 _seqgen_names = {
     "GaussianSequence": GaussianSequence,
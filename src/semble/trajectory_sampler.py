@@ -1,10 +1,50 @@
-from scipy.integrate import solve_ivp
+from scipy.integrate import solve_ivp, RK23, RK45, DOP853, Radau, BDF, LSODA
+from scipy.optimize import OptimizeResult
+from scipy import sparse
 import numpy as np
 
 from .dynamics import Dynamics
 from .sequence_generators import SequenceGenerator
 from .initial_state import InitialStateGenerator
 
+# solve_ivp methods that use the Jacobian (LSODA only takes a dense one, so it is left out)
+_JAC_METHODS = ("BDF", "Radau")
+
+# simulators with a fixed time step and a simulate_batch method: spectral ("SM") and LIF networks
+_FIXED_STEP_METHODS = ("SM", "Brian2", "Numpy")
+
+_ODE_SOLVERS = {
+    "RK23": RK23,
+    "RK45": RK45,
+    "DOP853": DOP853,
+    "Radau": Radau,
+    "BDF": BDF,
+    "LSODA": LSODA,
+}
+
+# the default tolerances of solve_ivp
+_RTOL, _ATOL = 1e-3, 1e-6
+
+
+def _counting_solver(solver_cls, stats):
+    '''Subclass of an OdeSolver that adds its accepted (and, for explicit
+    Runge-Kutta methods, rejected) steps to stats.'''
+
+    class CountingSolver(solver_cls):
+
+        def _step_impl(self):
+            nfev = self.nfev
+            success, message = super()._step_impl()
+            stats["n_steps"] += 1
+
+            # an explicit RK step attempt costs n_stages evaluations
+            if hasattr(self, "n_stages"):
+                stats["n_rejected"] += (self.nfev - nfev) // self.n_stages - 1
+
+            return success, message
+
+    return CountingSolver
+
 
 class TrajectorySampler:
 
@@ -13,12 +53,14 @@ class TrajectorySampler:
                  control_delta,
                  control_generator: SequenceGenerator,
                  method=None,
-                 initial_state_generator: InitialStateGenerator = None):
+                 initial_state_generator: InitialStateGenerator = None,
+                 segmented=False):
         self._n = dynamics.n
         self._ode_method = dynamics.default_method if not method else method
         self._dyn = dynamics
         self._delta = control_delta  # control sampling time
         self._seq_gen = control_generator
+        self._segmented = segmented  # integrate each control interval separately
 
         self.state_generator = (initial_state_generator
                                 if initial_state_generator else
@@ -27,6 +69,13 @@ class TrajectorySampler:
         self._rng = np.random.default_rng()
         self._init_time = 0.
 
+        self.reset_stats()
+        if self._ode_method in _ODE_SOLVERS:
+            self._solver = _counting_solver(_ODE_SOLVERS[self._ode_method],
+                                            self.stats)
+        else:
+            self._solver = None
+
         self.x0_scaler = None
         self.y_scaler = None
         self.u_scaler = None
@@ -34,62 +83,281 @@ class TrajectorySampler:
     def dims(self):
         return self._dyn.dims()
 
-    def reset_rngs(self):
-        self._seq_gen._rng = np.random.default_rng()
-        self.state_generator.rng = np.random.default_rng()
-        self._rng = np.random.default_rng()
+    def reset_stats(self):
+        '''Resets the solver statistics summed over all integrations: right hand
+        side and Jacobian evaluations, LU decompositions and solver steps.'''
+        if not hasattr(self, "stats"):
+            self.stats = {}
+
+        # updated in place, the counting solver holds a reference
+        self.stats.update(nfev=0, njev=0, nlu=0, n_steps=0, n_rejected=0)
+
+    def reset_rngs(self, seed=None):
+        # one independent stream per random component, derived from seed
+        if isinstance(seed, np.random.SeedSequence):
+            # fresh copy, spawning from seed itself would advance its child counter
+            seed = np.random.SeedSequence(seed.entropy,
+                                          spawn_key=seed.spawn_key)
+        else:
+            seed = np.random.SeedSequence(seed)
+        seq_seed, state_seed, sample_seed, legacy_seed = seed.spawn(4)
+        self._seq_gen.reset_rng(seq_seed)
+        self.state_generator.reset_rng(state_seed)
+        self._rng = np.random.default_rng(sample_seed)
+
+        # some generators still draw from the global numpy RNG
+        np.random.seed(legacy_seed.generate_state(1)[0])
+
+    def get_example(self, time_horizon, n_samples, full_state=True):
+        '''Returns a trajectory (y0, t, y, control_seq, y_full), sampled at n_samples + 1 times.
 
-    def get_example(self, time_horizon, n_samples):
-        ### Returns a trajectory ###
+        y_full is the state at every simulation step for the spectral models, every full_state_dt for
+        the LIF models (the same as y for ODE models), or None if not full_state. control_seq is a
+        PiecewiseConstant if the control generator samples compact sequences.'''
         y0 = self.state_generator.sample()
-        if self._ode_method == "SM": # spectral method
+        if self._ode_method in _FIXED_STEP_METHODS:
             control_seq = self._seq_gen.sample(time_range=(self._init_time,
                                                         time_horizon),
                                             delta=self._delta)
-            y, t = self._dyn.simulate(y0,control_seq,n_samples,time_horizon,self._init_time)
-            
-        elif self._ode_method == "Brian2":
-            control_seq = self._seq_gen.sample(time_range=(self._init_time,
-                                                        time_horizon),
-                                            delta=self._delta)
-            y, t = self._dyn.simulate(y0,control_seq,n_samples,time_horizon,self._init_time)
-            # t_all = t
-            t_samples = self._init_time + (time_horizon - self._init_time) * lhs(
-                n_samples, self._rng)
-            t_samples = np.sort(np.append(t_samples, [self._init_time]))
-            closest_indices = np.abs(t[:, None] - t_samples).argmin(axis=0) # use this since the brian2 simulator uses a fixed time step
-            y_full = y
-            y_full = y_full.T
-            t = t[closest_indices]
-            y = y[:, closest_indices]
-            y = y.T
-            t = t.reshape(-1, 1)
+            t_samples = self._sample_times(time_horizon, n_samples)
+            y_full, _, y, t = self._dyn.simulate_batch(
+                y0[None], [control_seq], n_samples, time_horizon,
+                self._init_time, t_samples[None], full_state)
+
+            y = y[0]
+            t = t[0].reshape(-1, 1)
+            y_full = y_full[0] if full_state else None
+
         else: 
 
             control_seq = self._seq_gen.sample(time_range=(self._init_time,
                                                         time_horizon),
                                             delta=self._delta)
 
-            def f(t, y):
-                n_control = int(np.floor((t - self._init_time) / self._delta))
+            def f(t, y, n_control):
                 u = control_seq[n_control]  # get u(t)
                 
                 return self._dyn(y, u)
 
-            t_samples = self._init_time + (time_horizon - self._init_time) * lhs(
-                n_samples, self._rng)
-            t_samples = np.sort(np.append(t_samples, [self._init_time]))
+            if self._dyn.jac is not None:
+                def jac(t, y, n_control):
+                    return self._dyn.jac(y, control_seq[n_control])
+            else:
+                jac = None
+
+            t_samples = self._sample_times(time_horizon, n_samples)
+            traj = self._integrate(f, y0, time_horizon, t_samples, jac,
+                                   self._dyn.jac_sparsity)
+
+            y = traj.y.T
+            t = traj.t.reshape(-1, 1)
+            y_full = y if full_state else None
+        return y0, t, y, control_seq, y_full
+
+    def _sample_times(self, time_horizon, n_samples):
+        # Latin Hypercube sampled times, plus the initial time
+        t_samples = self._init_time + (time_horizon - self._init_time) * lhs(
+            n_samples, self._rng)
+        return np.sort(np.append(t_samples, [self._init_time]))
+
+    def get_example_batch(self, time_horizon, n_samples, seeds,
+                          full_state=True):
+        '''Returns one trajectory per seed, see get_example.
+
+        For ODE models all trajectories are integrated together as one stacked
+        system using Dynamics._dx_batch, so they share the solver's step size.
+        The solver's error norm is the RMS over all of them, so the tolerances
+        are divided by sqrt(batch size) to keep the error of every trajectory
+        within the tolerances of a single one. The trajectories are still not
+        exactly the ones integrated alone, as the steps depend on the batch.
+        Spectral models advance all fields together with simulate_batch, the
+        Brian2 models simulate their n_copies copies of the network in one run
+        and LIFNumpy steps all trajectories together.'''
+        if self._ode_method in _FIXED_STEP_METHODS:
+            y0s, control_seqs, t_samples = [], [], []
+            for seed in seeds:
+                self.reset_rngs(seed)
+                y0s.append(self.state_generator.sample())
+                control_seqs.append(
+                    self._seq_gen.sample(time_range=(self._init_time,
+                                                     time_horizon),
+                                         delta=self._delta))
+                t_samples.append(self._sample_times(time_horizon, n_samples))
+
+            # a list rather than a stack, which keeps compact (PiecewiseConstant) controls compact
+            y_full, _, ys, ts = self._dyn.simulate_batch(
+                np.stack(y0s), control_seqs, n_samples,
+                time_horizon, self._init_time, np.stack(t_samples),
+                full_state)
+
+            if not full_state:
+                y_full = [None] * len(seeds)
+
+            return [(y0, t.reshape(-1, 1), y, control_seq, y_f)
+                    for (y0, t, y, control_seq, y_f) in zip(
+                        y0s, ts, ys, control_seqs, y_full)]
+
+        y0s, control_seqs, t_samples = [], [], []
+        for seed in seeds:
+            self.reset_rngs(seed)
+            y0s.append(self.state_generator.sample())
+            control_seqs.append(
+                self._seq_gen.sample(time_range=(self._init_time, time_horizon),
+                                     delta=self._delta))
+            t_samples.append(self._sample_times(time_horizon, n_samples))
+
+        batch_size = len(seeds)
+        controls = np.stack(control_seqs)
+
+        def f(t, y, n_control):
+            U = controls[:, n_control]  # get u(t) for every trajectory
+
+            return self._dyn._dx_batch(y.reshape(batch_size, self._n),
+                                       U).reshape(-1)
+
+        # the trajectories are independent, so the Jacobian is block diagonal
+        if self._dyn.jac is not None:
+            def jac(t, y, n_control):
+                return sparse.block_diag([
+                    self._dyn.jac(x, u) for (x, u) in zip(
+                        y.reshape(batch_size, self._n), controls[:, n_control])
+                ], format='csc')
+        else:
+            jac = None
+
+        block = (self._dyn.jac_sparsity if self._dyn.jac_sparsity is not None
+                 else np.ones((self._n, self._n)))
+        jac_sparsity = sparse.block_diag([block] * batch_size, format='csc')
+
+        t_eval, inv_idxs = np.unique(np.concatenate(t_samples),
+                                     return_inverse=True)
+        traj = self._integrate(f, np.concatenate(y0s), time_horizon, t_eval,
+                               jac, jac_sparsity,
+                               tol_scale=1 / np.sqrt(batch_size))
+
+        y_all = traj.y.T.reshape(len(t_eval), batch_size, self._n)
+        inv_idxs = inv_idxs.reshape(batch_size, -1)
+
+        examples = []
+        for k in range(batch_size):
+            y = y_all[inv_idxs[k], k]
+            t = traj.t[inv_idxs[k]].reshape(-1, 1)
+            examples.append((y0s[k], t, y, control_seqs[k],
+                             y if full_state else None))
+
+        return examples
+
+    def _integrate(self, fun, y0, time_horizon, t_eval, jac=None,
+                   jac_sparsity=None, tol_scale=1.):
+        '''Integrates fun(t, y, n_control), n_control being the index of the
+        control interval that contains t, with the default tolerances of
+        solve_ivp times tol_scale.'''
+        rtol, atol = _RTOL * tol_scale, _ATOL * tol_scale
+
+        if self._ode_method not in _JAC_METHODS:
+            jac, jac_sparsity = None, None
+
+        if self._segmented:
+            traj = solve_segmented(fun, (self._init_time, time_horizon), y0,
+                                   self._delta, t_eval, self._solver,
+                                   jac=jac, jac_sparsity=jac_sparsity,
+                                   rtol=rtol, atol=atol)
+        else:
+            def control_index(t):
+                return int(np.floor((t - self._init_time) / self._delta))
+
+            options = {"rtol": rtol, "atol": atol}
+            if jac is not None:
+                options["jac"] = lambda t, y: jac(t, y, control_index(t))
+            elif jac_sparsity is not None:
+                options["jac_sparsity"] = jac_sparsity
+
             traj = solve_ivp(
-                f,
+                lambda t, y: fun(t, y, control_index(t)),
                 (self._init_time, time_horizon),
                 y0,
-                t_eval=t_samples,
-                method=self._ode_method,
+                t_eval=t_eval,
+                method=self._solver,
+                **options,
             )
 
-            y = traj.y.T
-            t = traj.t.reshape(-1, 1)
-        return y0, t, y, control_seq, y_full
+        for k in ("nfev", "njev", "nlu"):
+            self.stats[k] += traj[k]
+
+        return traj
+
+
+def solve_segmented(fun, t_span, y0, delta, t_eval, method, jac=None,
+                    jac_sparsity=None, rtol=_RTOL, atol=_ATOL):
+    '''Solves an ODE with piecewise constant controls one control interval
+    [t0 + k*delta, t0 + (k+1)*delta] at a time.
+
+    fun(t, y, k) (and jac(t, y, k)) are only called with the index k of the
+    current interval, so the solver never steps over a control discontinuity.
+    The state is carried over between intervals and each interval starts with
+    the last step size of the previous one, although multistep methods (BDF,
+    LSODA) restart at order one. Returns the solution at the sorted times
+    t_eval, with the same fields as solve_ivp. method is the name of a
+    solve_ivp method or an OdeSolver subclass.'''
+    solver_cls = _ODE_SOLVERS[method] if isinstance(method, str) else method
+    t0, t_end = t_span
+    # with a tolerance, so that a horizon which is a multiple of delta does not
+    # get an empty last interval through round-off (e.g. 2.1 / 0.3 > 7)
+    n_segments = int(np.ceil((t_end - t0) / delta - 1e-9))
+
+    t_eval = np.asarray(t_eval)
+    ys = np.empty((len(y0), len(t_eval)))
+    i_eval = 0
+
+    y = np.asarray(y0, dtype=float)
+    step_size = None
+    nfev, njev, nlu = 0, 0, 0
+
+    for k in range(n_segments):
+        t_start = t0 + k * delta
+        t_stop = min(t0 + (k + 1) * delta, t_end)
+        if t_stop <= t_start:
+            break
+
+        options = {"rtol": rtol, "atol": atol}
+        if jac is not None:
+            options["jac"] = lambda t, y, k=k: jac(t, y, k)
+        elif jac_sparsity is not None:
+            options["jac_sparsity"] = jac_sparsity
+        if step_size is not None:
+            options["first_step"] = min(step_size, t_stop - t_start)
+
+        solver = solver_cls(lambda t, y, k=k: fun(t, y, k), t_start, y,
+                            t_stop, **options)
+
+        while solver.status == "running":
+            solver.step()
+
+            if solver.status == "failed":
+                return OptimizeResult(t=t_eval[:i_eval], y=ys[:, :i_eval],
+                                      nfev=nfev + solver.nfev,
+                                      njev=njev + solver.njev,
+                                      nlu=nlu + solver.nlu, status=-1,
+                                      message="Required step size is less than spacing between numbers.",
+                                      success=False)
+
+            if solver.t < t_stop:
+                step_size = solver.step_size  # not shortened by the interval end
+
+            if i_eval < len(t_eval) and t_eval[i_eval] <= solver.t:
+                sol = solver.dense_output()
+                while i_eval < len(t_eval) and t_eval[i_eval] <= solver.t:
+                    ys[:, i_eval] = sol(t_eval[i_eval])
+                    i_eval += 1
+
+        y = solver.y
+        nfev += solver.nfev
+        njev += solver.njev
+        nlu += solver.nlu
+
+    return OptimizeResult(t=t_eval, y=ys, nfev=nfev, njev=njev, nlu=nlu,
+                          status=0, message="The solver successfully reached the end of the integration interval.",
+                          success=True)
 
 
 def lhs(n_samples, rng):